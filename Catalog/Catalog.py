@@ -1,6 +1,6 @@
 import cherrypy
 import os
-from catalog_api import CatalogAPI
+from catalog_api import CatalogAPI, json_handler
 from catalog_utils import CATALOG_FILE
 
 # ===================== App Setup =====================
@@ -67,6 +67,11 @@ def run_server():
             'request.dispatch': get_dispatcher(),
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'application/json; charset=utf-8')],
+            # ETag from the response body; a GET with a matching If-None-Match gets an empty 304
+            'tools.etags.on': True,
+            'tools.etags.autotags': True,
+            # Applies to every json_out-decorated action: one bytes body, so its length is known up front
+            'tools.json_out.handler': json_handler,
         }
     }
 
@@ -1,16 +1,24 @@
+import re
 import cherrypy
 import json
 from datetime import datetime, timezone
 
-from catalog_utils import load_catalog, save_catalog, generate_device_topics
+from catalog_utils import load_catalog, save_catalog, read_catalog, read_catalog_snapshot, find_user, find_device, generate_device_topics
 
 # ===================== Controller Helpers =====================
 
+_NON_HEX_RE = re.compile(r'[^0-9A-Fa-f]')
+
 def http_error(status_code, payload):
     """Set status and return JSON payload"""
     cherrypy.response.status = status_code
     return payload
 
+def json_handler(*args, **kwargs):
+    """json_out handler: encode the reply with a single json.dumps instead of CherryPy's chunked iterencode"""
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
 # ===================== Controller =====================
 
 class CatalogAPI:
@@ -18,7 +26,7 @@ class CatalogAPI:
     def health(self):
         """GET /health"""
         try:
-            catalog = load_catalog()
+            catalog = read_catalog()
             return {
                 "status": "healthy",
                 "service": "SmartChill Catalog Service",
@@ -36,7 +44,7 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def info(self):
         """GET /info - System information and statistics"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         total_devices = len(catalog['devicesList'])
         assigned_devices = len([d for d in catalog['devicesList'] if d.get('user_assigned', False)])
 
@@ -73,7 +81,8 @@ class CatalogAPI:
         """POST /devices/register - Register or sync device"""
         data = cherrypy.request.json or {}
         
-        print(f"[DEVICE_REG] Received device registration: {json.dumps(data, indent=2)}")
+        # One compact line: indent=2 is the slow encoder path and spreads each registration over many log lines
+        print(f"[DEVICE_REG] Received device registration: {json.dumps(data, separators=(',', ':'))}")
 
         # Validate required fields
         required_fields = ['mac_address', 'model', 'sensors']
@@ -229,10 +238,13 @@ class CatalogAPI:
 
     # ============= DEVICE MANAGEMENT =============
     @cherrypy.tools.json_out()
-    def get_devices(self):
-        """GET /devices"""
-        catalog = load_catalog()
-        return catalog['devicesList']
+    def get_devices(self, mac_address=None):
+        """GET /devices, optionally filtered with ?mac_address= (separators and case ignored)"""
+        catalog = read_catalog()
+        if mac_address is None:
+            return catalog['devicesList']
+        target = _NON_HEX_RE.sub('', mac_address).upper()
+        return [d for d in catalog['devicesList'] if _NON_HEX_RE.sub('', d.get('mac_address') or '').upper() == target]
     
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -286,17 +298,15 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_device(self, device_id):
         """GET /devices/{device_id}"""
-        catalog = load_catalog()
-        for device in catalog['devicesList']:
-            if device['deviceID'] == device_id:
-                return device
+        device = find_device(device_id)
+        if device is not None:
+            return device
         return http_error(404, {"error": "Device not found"})
 
     @cherrypy.tools.json_out()
     def device_exists(self, device_id):
         """GET /devices/{device_id}/exists - Check if device exists"""
-        catalog = load_catalog()
-        exists = any(device['deviceID'] == device_id for device in catalog['devicesList'])
+        exists = find_device(device_id) is not None
         return {
             "device_id": device_id,
             "exists": exists,
@@ -306,14 +316,14 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_unassigned_devices(self):
         """GET /devices/unassigned"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         unassigned = [d for d in catalog['devicesList'] if not d.get('user_assigned', False)]
         return unassigned
 
     @cherrypy.tools.json_out()
     def get_devices_by_model(self, model):
         """GET /devices/by-model/{model}"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         model_devices = [d for d in catalog['devicesList'] if d.get('model') == model]
         return model_devices
 
@@ -381,13 +391,13 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_services(self):
         """GET /services"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         return catalog['servicesList']
 
     @cherrypy.tools.json_out()
     def get_service(self, service_id):
         """GET /services/{service_id}"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         for service in catalog['servicesList']:
             if service['serviceID'] == service_id:
                 return service
@@ -397,16 +407,15 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_users(self):
         """GET /users"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         return catalog['usersList']
 
     @cherrypy.tools.json_out()
     def get_user(self, user_id):
         """GET /users/{user_id}"""
-        catalog = load_catalog()
-        for user in catalog['usersList']:
-            if user['userID'] == user_id:
-                return user
+        user = find_user(user_id)
+        if user is not None:
+            return user
         return http_error(404, {"error": "User not found"})
 
     @cherrypy.tools.json_in()
@@ -418,14 +427,19 @@ class CatalogAPI:
             if field not in data:
                 return http_error(400, {"error": f"Missing required field: {field}"})
 
+        if not isinstance(data['userID'], str) or not data['userID']:
+            return http_error(400, {"error": "userID must be a non-empty string"})
+        # Normalized once, used for the duplicate check and the stored record
+        user_id = data['userID'].lower()
+
         catalog = load_catalog()
         # duplicate check
         for user in catalog['usersList']:
-            if user['userID'].lower() == data['userID'].lower():
-                return http_error(409, {"error": "User already exists"})
+            if user['userID'].lower() == user_id:
+                return http_error(409, {"error": "User already exists", "user": user})
 
         new_user = {
-            "userID": data['userID'].lower(),  # lowercase
+            "userID": user_id,  # lowercase
             "userName": data['userName'],
             "telegram_chat_id": data.get("telegram_chat_id", None),
             "devicesList": [],
@@ -493,17 +507,14 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_user_devices(self, user_id):
         """GET /users/{user_id}/devices"""
-        catalog = load_catalog()
-        user = next((u for u in catalog['usersList'] if u['userID'] == user_id), None)
+        # One snapshot: a save between two separate reads could pair the user with another file version
+        catalog, users, _ = read_catalog_snapshot()
+        user = users.get(user_id)
         if not user:
             return http_error(404, {"error": "User not found"})
 
-        user_devices = []
-        ids = [d['deviceID'] for d in user.get('devicesList', [])]
-        for device in catalog['devicesList']:
-            if device['deviceID'] in ids:
-                user_devices.append(device)
-        return user_devices
+        ids = {d['deviceID'] for d in user.get('devicesList', [])}
+        return [device for device in catalog['devicesList'] if device['deviceID'] in ids]
 
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
@@ -586,13 +597,13 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_device_models(self):
         """GET /models"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         return catalog.get('deviceModels', {})
 
     @cherrypy.tools.json_out()
     def get_device_model(self, model):
         """GET /models/{model}"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         if model in catalog.get('deviceModels', {}):
             return catalog['deviceModels'][model]
         return http_error(404, {"error": "Device model not found"})
@@ -601,7 +612,7 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_mqtt_topics(self):
         """GET /mqtt/topics"""
-        catalog = load_catalog()
+        catalog = read_catalog()
         all_topics = {"device_topics": {}, "service_topics": {}}
 
         for device in catalog['devicesList']:
@@ -623,13 +634,12 @@ class CatalogAPI:
     @cherrypy.tools.json_out()
     def get_device_mqtt_topics(self, device_id):
         """GET /mqtt/topics/{device_id}"""
-        catalog = load_catalog()
-        for device in catalog['devicesList']:
-            if device['deviceID'] == device_id:
-                return {
-                    "device_id": device_id,
-                    "model": device['model'],
-                    "topics": device['mqtt_topics'],
-                    "mqtt_config": device.get('mqtt_config', {})
-                }
+        device = find_device(device_id)
+        if device is not None:
+            return {
+                "device_id": device_id,
+                "model": device['model'],
+                "topics": device['mqtt_topics'],
+                "mqtt_config": device.get('mqtt_config', {})
+            }
         return http_error(404, {"error": "Device not found"})
\ No newline at end of file
@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 from datetime import datetime, timezone
 
 # ===================== Constants & Configuration =====================
@@ -36,13 +37,58 @@ def load_catalog():
             ]
         }
 
+# Parsed catalog shared by read-only requests, with userID/deviceID indexes.
+# Rebuilt when the file's (mtime, size, inode) changes, i.e. after every save_catalog.
+_read_cache = {"key": None, "catalog": None, "users": {}, "devices": {}}
+_read_lock = threading.Lock()
+
+def _read_state():
+    """Return the cached read state, reloading it if the catalog file changed"""
+    try:
+        st = os.stat(CATALOG_FILE)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        key = None
+    with _read_lock:
+        if key is None or _read_cache["key"] != key:
+            catalog = load_catalog()
+            _read_cache.update(
+                key=key,
+                catalog=catalog,
+                # Reversed so the first entry wins on duplicate IDs, like a linear scan
+                users={u['userID']: u for u in reversed(catalog.get('usersList', []))},
+                devices={d['deviceID']: d for d in reversed(catalog.get('devicesList', []))},
+            )
+        return _read_cache["catalog"], _read_cache["users"], _read_cache["devices"]
+
+def read_catalog():
+    """Load catalog for read-only use (shared object: do not modify it)"""
+    return _read_state()[0]
+
+def read_catalog_snapshot():
+    """Catalog plus its userID and deviceID indexes, all from the same file version (read-only)"""
+    return _read_state()
+
+def find_user(user_id):
+    """Look up a user by userID (read-only)"""
+    return _read_state()[1].get(user_id)
+
+def find_device(device_id):
+    """Look up a device by deviceID (read-only)"""
+    return _read_state()[2].get(device_id)
+
 def save_catalog(catalog):
     """Save catalog to JSON file with updated timestamp"""
     catalog['lastUpdate'] = datetime.now(timezone.utc).isoformat()
     os.makedirs(os.path.dirname(CATALOG_FILE), exist_ok=True)
     try:
-        with open(CATALOG_FILE, 'w') as f:
-            json.dump(catalog, f, indent=4)
+        # Write to a temp file and swap it in: a crash mid-write never leaves a truncated catalog
+        tmp_file = f"{CATALOG_FILE}.tmp"
+        # One dumps + one write: json.dump would issue a write() per encoded fragment
+        data = json.dumps(catalog, indent=4)
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, CATALOG_FILE)
         print(f"[CATALOG] Catalog saved to {CATALOG_FILE}")
     except Exception as e:
         print(f"[ERROR] Failed to save catalog: {e}")
@@ -48,6 +48,8 @@ class FridgeSimulator:
         self.broker_port = self.settings["mqtt_data"]["port"]
         self.topic_template = self.settings["mqtt_data"]["topic_template"]
         self.include_events = self.settings["mqtt_data"].get("include_events", [])
+        # Formatted sensor topics: {(device_id, sensor): topic}
+        self._sensor_topics = {}
         
         # Telemetry configuration
         self.publish_qos = self.settings["telemetry"].get("publish_qos", 1)
@@ -383,21 +385,31 @@ class FridgeSimulator:
                     self.mqtt_client.myPublish(topic, senml_payload)
                     print(f"[EVENT] Door CLOSED after {duration:.1f}s - Notification sent")
     
+    def _sensor_topic(self, sensor_type):
+        """Sensor topic, formatted once per device ID instead of on every publish"""
+        key = (self.device_id, sensor_type)
+        topic = self._sensor_topics.get(key)
+        if topic is None:
+            topic = build_topic(self.topic_template, self.model, self.device_id, sensor_type)
+            self._sensor_topics[key] = topic
+        return topic
+
     def publish_sensor_data(self):
         """Publish sensor data"""
         if not self.connected or not self.mqtt_client or not self.device_id:
             return
             
         current_time = time.time()
+        publish = self.mqtt_client.myPublish
         for sensor_type, value in self.sensors.items():
             interval = self.sampling_intervals.get(sensor_type, 60)
             if current_time - self.last_publish[sensor_type] >= interval:
                 
-                topic = build_topic(self.topic_template, self.model, self.device_id, sensor_type)
+                topic = self._sensor_topic(sensor_type)
                 
                 if topic:
                     senml_payload = create_senml_payload(self.device_id, sensor_type, value, current_time)
-                    self.mqtt_client.myPublish(topic, senml_payload)
+                    publish(topic, senml_payload)
                     self.last_publish[sensor_type] = current_time
                     
                     unit = get_sensor_unit(sensor_type)
@@ -20,6 +20,8 @@ class FoodSpoilageControl:
         
         # Service configuration from settings
         self.service_info = self.settings["serviceInfo"]
+        # Endpoints do not change at runtime: parse the MQTT topics once
+        self.subscribe_topics = tuple(self.extract_mqtt_topics())
         self.service_id = self.service_info["serviceID"]
         self.catalog_url = self.settings["catalog"]["url"]
         
@@ -36,6 +38,8 @@ class FoodSpoilageControl:
         
         # Threading
         self.running = True
+        # Set by shutdown(): wakes run() and the registration thread right away
+        self.stop_event = threading.Event()
         self.config_lock = threading.RLock()
         
         print(f"[INIT] {self.service_id} service starting...")
@@ -70,7 +74,7 @@ class FoodSpoilageControl:
         subscribe_topics = []
         for endpoint in self.service_info["endpoints"]:
             if endpoint.startswith("MQTT Subscribe: "):
-                topic = endpoint.replace("MQTT Subscribe: ", "")
+                topic = endpoint.removeprefix("MQTT Subscribe: ")
                 subscribe_topics.append(topic)
         return subscribe_topics
     
@@ -365,7 +369,7 @@ class FoodSpoilageControl:
             time.sleep(2)
             self.connected = True
             
-            topics = self.extract_mqtt_topics()
+            topics = self.subscribe_topics
             for topic in topics:
                 self.mqtt_client.mySubscribe(topic)
                 print(f"[MQTT] Subscribed: {topic}")
@@ -389,9 +393,9 @@ class FoodSpoilageControl:
 
     def periodic_registration(self):
         interval = self.settings["catalog"]["registration_interval_seconds"]
-        while self.running:
-            time.sleep(interval)
-            if self.running: self.register_with_catalog()
+        # wait() returns True as soon as shutdown() is called
+        while not self.stop_event.wait(interval):
+            self.register_with_catalog()
     
     def status_monitor_loop(self):
         while self.running:
@@ -410,10 +414,11 @@ class FoodSpoilageControl:
         threading.Thread(target=self.status_monitor_loop, daemon=True).start()
         
         try:
-            while self.running: time.sleep(1)
+            self.stop_event.wait()
         except KeyboardInterrupt: self.shutdown()
 
     def shutdown(self):
         print("[SHUTDOWN] Stopping service...")
         self.running = False
+        self.stop_event.set()
         if self.mqtt_client: self.mqtt_client.stop()
\ No newline at end of file
@@ -26,6 +26,8 @@ class InfluxDBAdaptor:
         
         # Service configuration from settings
         self.service_info = self.settings["serviceInfo"]
+        # Endpoints do not change at runtime: parse the MQTT topics once
+        self.subscribe_topics = tuple(self.extract_mqtt_topics())
         self.service_id = self.service_info["serviceID"]
         self.catalog_url = self.settings["catalog"]["url"]
         
@@ -191,7 +193,7 @@ class InfluxDBAdaptor:
         
         for endpoint in self.service_info["endpoints"]:
             if endpoint.startswith("MQTT Subscribe: "):
-                topic = endpoint.replace("MQTT Subscribe: ", "")
+                topic = endpoint.removeprefix("MQTT Subscribe: ")
                 subscribe_topics.append(topic)
         
         return subscribe_topics
@@ -461,7 +463,7 @@ class InfluxDBAdaptor:
             self.connected = True
             
             # Extract and subscribe to topics from service endpoints
-            subscribe_topics = self.extract_mqtt_topics()
+            subscribe_topics = self.subscribe_topics
             for topic in subscribe_topics:
                 self.mqtt_client.mySubscribe(topic)
                 print(f"[MQTT] Subscribed to: {topic}")
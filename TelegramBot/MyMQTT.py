@@ -1,6 +1,6 @@
 import paho.mqtt.client as PahoMQTT
 import json
-import time # Import time module
+import threading
 
 class MyMQTT:
     def __init__(self, clientID, broker, port, notifier=None):
@@ -12,6 +12,8 @@ class MyMQTT:
         self._isSubscriber = False
         # ---- New flag ----
         self._isConnected = False 
+        # Set by myOnConnect, so start() wakes up as soon as CONNACK arrives
+        self._connected_event = threading.Event()
         # ------------------
         
         self._paho_mqtt = PahoMQTT.Client(callback_api_version=PahoMQTT.CallbackAPIVersion.VERSION1,
@@ -29,6 +31,7 @@ class MyMQTT:
             print(f"Connected to {self.broker} with result code: {rc}", flush=True)
             # ---- Set flag on success ----
             self._isConnected = True
+            self._connected_event.set()
             # ---------------------------
         else:
             print(f"Failed to connect to {self.broker}. Error code: {rc}", flush=True)
@@ -40,6 +43,7 @@ class MyMQTT:
     def myOnDisconnect(self, client, userdata, rc):
         print(f"Disconnected from {self.broker} with result code: {rc}", flush=True)
         self._isConnected = False # Update flag on disconnect
+        self._connected_event.clear()
 
     def myOnMessageReceived (self, paho_mqtt , userdata, msg):
         if self.notifier:
@@ -59,13 +63,14 @@ class MyMQTT:
              return
         # Ensure msg is JSON serializable (usually a dict) before dumping
         try:
-             payload = json.dumps(msg)
+             # Compact separators: smaller payload, less work to encode
+             payload = json.dumps(msg, separators=(",", ":"))
              self._paho_mqtt.publish(topic, payload, 2)
         except TypeError as e:
              print(f"Error: Could not serialize message for topic {topic}: {e}. Message: {msg}", flush=True)
        
     # In MyMQTT.py
-    def mySubscribe (self, topic):
+    def mySubscribe (self, topic, qos=2):
         # Check connection before subscribing
         if not self._isConnected:
              print(f"WARN: Cannot subscribe to {topic}, MQTT not connected.", flush=True)
@@ -73,7 +78,7 @@ class MyMQTT:
              return False 
         try:
             # Paho subscribe returns a tuple: (result, mid)
-            result, mid = self._paho_mqtt.subscribe(topic, 2) 
+            result, mid = self._paho_mqtt.subscribe(topic, qos)
 
             if result == PahoMQTT.MQTT_ERR_SUCCESS:
                 print(f"Successfully initiated subscription to {topic} (mid={mid})", flush=True)
@@ -98,19 +103,40 @@ class MyMQTT:
              # Re-raise the exception so the caller's try-except block can catch it
              raise e
  
+    def mySubscribeMany (self, topics):
+        """Subscribes to several topics with a single SUBSCRIBE packet. topics: list of (topic, qos)."""
+        if not self._isConnected:
+             print(f"WARN: Cannot subscribe to {len(topics)} topics, MQTT not connected.", flush=True)
+             return False
+        if not topics:
+             return True
+
+        result, mid = self._paho_mqtt.subscribe(list(topics))
+        if result != PahoMQTT.MQTT_ERR_SUCCESS:
+             print(f"ERROR: Failed to subscribe to {len(topics)} topics. Result code: {result}", flush=True)
+             return False
+
+        print(f"Successfully initiated subscription to {len(topics)} topics (mid={mid})", flush=True)
+        # Track topics for unsubscribe(), same as mySubscribe
+        if not isinstance(self._topic, list):
+             self._topic = [self._topic] if self._topic else []
+        for topic, _qos in topics:
+             if topic not in self._topic: self._topic.append(topic)
+        self._isSubscriber = True
+        return True
+ 
     def start(self):
         #manage connection to broker
         try:
             print(f"Attempting to connect to MQTT broker: {self.broker}:{self.port}", flush=True)
             self._isConnected = False # Reset flag before connection attempt
+            self._connected_event.clear()
             self._paho_mqtt.connect(self.broker, self.port)
             self._paho_mqtt.loop_start()
             
             # ---- Wait for connection confirmation ----
             max_wait_time = 10 # Seconds to wait for connection
-            start_time = time.time()
-            while not self._isConnected and time.time() - start_time < max_wait_time:
-                time.sleep(0.1) # Wait briefly
+            self._connected_event.wait(max_wait_time)
             # ----------------------------------------
 
             if self._isConnected:
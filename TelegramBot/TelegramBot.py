@@ -1,8 +1,9 @@
 import traceback
 import sys
+from typing import Final
 from bot_service import TelegramBotService
 
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE: Final[str] = "settings.json"
 
 def main():
     """
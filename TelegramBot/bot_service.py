@@ -1,16 +1,48 @@
 import time
 import json
+import queue
 import threading
+from collections import deque
 import telepot
+import telepot.api
+import telepot.exception
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Final
 
 from MyMQTT import MyMQTT
-from bot_utils import load_settings
-from catalog_client import CatalogClient
+from bot_utils import load_settings, RateLimiter
+from catalog_client import CatalogClient, CatalogError
 from telegram_handlers import BotHandlers
 
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE: Final[str] = "settings.json"
+ALERT_BATCH_WINDOW = 1.0  # seconds alerts for the same chat are collected before sending
+ALERT_BATCH_MAX = 10      # send right away once this many alerts are pending for a chat
+ALERT_SENDER_WORKERS = 8
+ALERT_LOOKUP_MAX_AGE = 10  # seconds device/user records fetched for alerts are reused
+
+# Alert message layout, filled in per alert
+ALERT_TEMPLATE = "{icon}* - {title}*\n\n{device}{body}"
+ALERT_DEVICE_TEMPLATE = "*Device:* {nick}\n`(ID: {device_id})`\n"
+SEVERITY_ICONS = {"critical": "🚨", "warning": "⚠️"}
+
+@lru_cache(maxsize=64)
+def alert_title(alert_name):
+    """Display title of an alert type, e.g. 'door_timeout' -> 'Door Timeout Alert'."""
+    return f"{alert_name.replace('_', ' ').title()} Alert"
+
+CONFIG_TOPIC_TYPES = ("config_data", "config_ack", "config_error")
+
+@lru_cache(maxsize=1024)
+def config_topic_type(topic):
+    """Config reply type carried by a topic, or None for alerts. Computed once per topic."""
+    for topic_type in CONFIG_TOPIC_TYPES:
+        if topic_type in topic:
+            return topic_type
+    return None
 
 def set_bot_descriptions(token: str, enable: bool = True):
     """Sets the bot's description and short description on Telegram."""
@@ -19,12 +51,60 @@ def set_bot_descriptions(token: str, enable: bool = True):
     short = "SmartChill – Keep your fridge under control." # what is seen on the bio
     desc = "Welcome to SmartChill!\nMonitor your fridge, get alerts, and cut waste.\n\n• 🔐 Login or register\n• 📣 Real-time alerts\n• 🧰 Device management"
     try:
-        requests.post(f"{base}/setMyShortDescription", data={"short_description": short}, timeout=5)
-        requests.post(f"{base}/setMyDescription", data={"description": desc}, timeout=5)
+        # One session, so both calls share a single keep-alive connection
+        with requests.Session() as http:
+            http.post(f"{base}/setMyShortDescription", data={"short_description": short}, timeout=5)
+            http.post(f"{base}/setMyDescription", data={"description": desc}, timeout=5)
         print("[DESC] Bot descriptions set")
     except Exception as e:
         print(f"[DESC] Failed to set descriptions: {e}")
 
+def _is_markdown_error(e):
+    """True if Telegram rejected a message because its Markdown entities could not be parsed."""
+    return e.error_code == 400 and "parse entities" in str(e.description).lower()
+
+class RateLimitedBot:
+    """
+    Wraps telepot.Bot so sends and edits go through the shared send limiter.
+    A 429 from Telegram is retried once, after the retry_after it asks for.
+    Callback query answers are sent in the background.
+    """
+
+    def __init__(self, bot, limiter, background):
+        self._bot = bot
+        self._limiter = limiter
+        self._background = background
+
+    def _call(self, method, *args, **kwargs):
+        self._limiter.acquire()
+        try:
+            return method(*args, **kwargs)
+        except telepot.exception.TooManyRequestsError as e:
+            retry_after = ((e.json or {}).get("parameters") or {}).get("retry_after", 1)
+            print(f"[SEND] Flood control hit, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            self._limiter.acquire()
+            return method(*args, **kwargs)
+
+    def sendMessage(self, *args, **kwargs):
+        return self._call(self._bot.sendMessage, *args, **kwargs)
+
+    def editMessageText(self, *args, **kwargs):
+        return self._call(self._bot.editMessageText, *args, **kwargs)
+
+    def answerCallbackQuery(self, *args, **kwargs):
+        # Only stops the button's loading spinner: the handler does not wait for the round-trip
+        self._background.submit(self._answer_callback, args, kwargs)
+
+    def _answer_callback(self, args, kwargs):
+        try:
+            self._bot.answerCallbackQuery(*args, **kwargs)
+        except Exception as e:
+            print(f"[SEND] Failed to answer callback query: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self._bot, name)
+
 class TelegramBotService:
     def __init__(self, settings_file=SETTINGS_FILE):
         # Load Settings
@@ -32,58 +112,109 @@ class TelegramBotService:
         self.service_info = self.settings["serviceInfo"]
         self.service_id = self.service_info["serviceID"]
         
-        # Init Components
-        self.catalog = CatalogClient(self.settings["catalog"]["url"])
+        # Update worker threads (chat shards), see start_telegram_loop
+        self.update_workers = max(1, int(self.settings["telegram"].get("update_workers", 4)))
+
+        # Init Components: one pooled catalog connection per thread that may call it at once
+        # (update workers plus one parallel lookup each, MQTT worker, periodic registration)
+        self.catalog = CatalogClient(self.settings["catalog"]["url"], pool_maxsize=2 * self.update_workers + 2)
         
         self.token = self.settings["telegram"]["TOKEN"]
+        # Per-message/per-update trace lines, off by default
+        self.debug = bool(self.settings["telegram"].get("debug_logging", False))
         self.bot = telepot.Bot(self.token)
+        self._size_telegram_pool()
         
         # MQTT Init
         self.mqtt_cfg = self.settings["mqtt"]
         client_id = f"{self.mqtt_cfg.get('clientID_prefix', 'tg_bot')}_{int(time.time())}"
         self.mqtt_client = MyMQTT(client_id, self.mqtt_cfg["brokerIP"], self.mqtt_cfg["brokerPort"], self)
         self.connected_mqtt = False
+        self.mqtt_queue = queue.Queue()
+        self.mqtt_worker_thread = None
         
         # Parse Endpoints for Topics
-        self.subscribe_topics = []
+        self.subscribe_topics = ()
         self.config_template = None
         self._parse_endpoints()
         
-        # Init Logic Handlers
-        self.handlers = BotHandlers(self.bot, self.catalog, self.mqtt_client, self.config_template)
+        # Init Logic Handlers (their sends share Telegram's 30 msg/s bot-wide limit with alerts).
+        # Kept just under the limit, with short bursts, so sends are paced here instead of hitting 429s.
+        self.send_limiter = RateLimiter(28, 1.0, burst=10)
+        self.callback_answers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="callback_answer")
+        self.send_bot = RateLimitedBot(self.bot, self.send_limiter, self.callback_answers)
+        self.handlers = BotHandlers(self.send_bot, self.catalog, self.mqtt_client, self.config_template, debug=self.debug)
         
         # State & Threading
-        self.running = True
+        self.stop_event = threading.Event()
         self.last_alert_time = {} 
+        # Read once: settings are not reloaded while the service runs
+        self.alert_cooldown_sec = self.settings.get("defaults", {}).get("alert_cooldown_minutes", 15) * 60
+        # Alerts are sent off the MQTT worker, through the same send limiter
+        self.alert_sender = ThreadPoolExecutor(max_workers=ALERT_SENDER_WORKERS, thread_name_prefix="alert_sender")
+        # Alerts waiting to be coalesced: {chat_id: [(text, alert_type, alert_key, queued_at), ...]}
+        self.pending_alerts = {}
+        # Also guards last_alert_time, which the MQTT worker, batch timers and senders all update
+        self.pending_alerts_lock = threading.Lock()
         self.message_loop_thread = None
+        # Per-chat pending updates, the way telepot's per_chat_id delegation keys them.
+        # A chat has an entry only while one pool task is draining it, so a chat's updates
+        # stay in order and no chat waits behind another chat's slow handler.
+        self.chat_updates = {}
+        self.chat_updates_lock = threading.Lock()
+        self.update_pool = ThreadPoolExecutor(max_workers=self.update_workers, thread_name_prefix="update_worker")
 
         # Set UI descriptions on startup
         set_bot_descriptions(self.token, enable=bool(self.settings["telegram"].get("SET_DESCRIPTIONS_ON_START", True)))
         print(f"[INIT] {self.service_id} initialized.")
 
+    def _size_telegram_pool(self):
+        """
+        Resizes telepot's shared keep-alive pool so the poller, the update workers
+        and the alert senders can all reuse connections to the Bot API at once.
+        """
+        # Relies on telepot internals (telepot.api._pools, telepot==12.7 in requirements.txt).
+        # If they change, or a proxy was configured, telepot's own pool is left as it is.
+        pools = getattr(telepot.api, "_pools", None)
+        if not isinstance(pools, dict) or type(pools.get("default")) is not urllib3.PoolManager:
+            print("[INIT] telepot connection pool not resized: unexpected telepot.api internals")
+            return
+        pools["default"] = urllib3.PoolManager(
+            num_pools=3, maxsize=1 + self.update_workers + ALERT_SENDER_WORKERS, retries=False, timeout=30
+        )
+
     def _parse_endpoints(self):
-        """Extracts topics from serviceInfo."""
+        """Extracts topics from serviceInfo (once, at init)."""
+        subscribe_topics = []
         for ep in self.service_info.get("endpoints", []):
-            if "MQTT Subscribe:" in ep:
-                topic = ep.replace("MQTT Subscribe: ", "").strip()
-                self.subscribe_topics.append(topic)
-            if "MQTT Publish:" in ep:
-                topic = ep.replace("MQTT Publish: ", "").strip()
+            if ep.startswith("MQTT Subscribe: "):
+                subscribe_topics.append(ep.removeprefix("MQTT Subscribe: ").strip())
+            elif ep.startswith("MQTT Publish: "):
+                topic = ep.removeprefix("MQTT Publish: ").strip()
                 if "config_update" in topic:
                     self.config_template = topic
                     print(f"[INIT] Config template found: {self.config_template}")
+        self.subscribe_topics = tuple(subscribe_topics)
 
     # --- MQTT Infrastructure ---
 
     def setup_mqtt(self):
         try:
-            self.mqtt_client.start()
-            time.sleep(2)
+            self.mqtt_worker_thread = threading.Thread(target=self._mqtt_worker, daemon=True)
+            self.mqtt_worker_thread.start()
+            # start() returns once the broker has acknowledged the connection (or after its timeout)
+            if not self.mqtt_client.start():
+                return False
             self.connected_mqtt = True
             
-            for t in self.subscribe_topics:
-                self.mqtt_client.mySubscribe(t)
-                print(f"[MQTT] Subscribed: {t}")
+            # Alerts are only forwarded to Telegram and are rate limited by the cooldown anyway:
+            # QoS 0 avoids the broker handshake per message. Config replies keep QoS 2,
+            # a lost reply would leave the user stuck waiting in the settings menu.
+            subscriptions = [(t, 0 if "/Alerts/" in t else 2) for t in self.subscribe_topics]
+            # One SUBSCRIBE packet (and one SUBACK) for all topics
+            if self.mqtt_client.mySubscribeMany(subscriptions):
+                for t, qos in subscriptions:
+                    print(f"[MQTT] Subscribed: {t} (QoS {qos})")
             return True
         except Exception as e:
             print(f"[MQTT] Connection Error: {e}")
@@ -92,16 +223,29 @@ class TelegramBotService:
     def notify(self, topic, payload_bytes):
         """
         Main MQTT Callback.
-        Routes messages either to Handler (Config Responses) or Alert Logic.
+        Only queues the message: catalog lookups and Telegram sends run on the
+        MQTT worker thread, so the paho network loop is never blocked.
         """
-        print(f"[MQTT] Received: {topic}")
+        self.mqtt_queue.put((topic, payload_bytes))
+
+    def _mqtt_worker(self):
+        """Drains the MQTT queue, one message at a time."""
+        while True:
+            item = self.mqtt_queue.get()
+            if item is None:
+                return
+            self._process_mqtt_message(*item)
+
+    def _process_mqtt_message(self, topic, payload_bytes):
+        """Routes messages either to Handler (Config Responses) or Alert Logic."""
+        if self.debug:
+            print(f"[MQTT] Received: {topic}")
         try:
-            payload = json.loads(payload_bytes.decode('utf-8'))
+            payload = json.loads(payload_bytes)
             
             # 1. Check if it's a Config Response (Data/Ack/Error)
-            # look for keywords in the topic or payload structure
-            if "config_data" in topic or "config_ack" in topic or "config_error" in topic:
-                topic_type = "config_data" if "config_data" in topic else ("config_ack" if "config_ack" in topic else "config_error")
+            topic_type = config_topic_type(topic)
+            if topic_type:
                 device_id = payload.get("device_id")
                 self.handlers.handle_config_response(device_id, payload, topic_type)
                 return
@@ -109,7 +253,7 @@ class TelegramBotService:
             # 2. Otherwise, treat as Alert/Notification
             self._handle_alert_notification(payload, topic)
             
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, UnicodeDecodeError):
             print(f"[MQTT] Non-JSON payload received on {topic}")
         except Exception as e:
             print(f"[ERROR] Notify error: {e}")
@@ -121,11 +265,14 @@ class TelegramBotService:
         user_id = payload.get('userID')
         msg_text = payload.get('message', 'Event occurred.')
         
-        response = requests.get(f"http://catalog:8001/devices/{device_id}") # request to get the device nick
-        device_nick = None
-        if response.status_code == 200:
-            device = response.json()
-            device_nick = device.get("user_device_name")
+        # Device record: used for the nickname and, when no userID is given, to find the owner
+        device = None
+        if device_id:
+            try:
+                device = self.catalog.get(f"/devices/{device_id}", max_age=ALERT_LOOKUP_MAX_AGE)
+            except CatalogError as e:
+                print(f"[ALERT] Could not fetch device {device_id}: {e}")
+        device_nick = device.get("user_device_name") if device else None
 
         # Determine Alert Type (from payload or topic)
         alert_type = payload.get('alert_type')
@@ -137,16 +284,12 @@ class TelegramBotService:
         # 1. Find Target Chat ID
         target_chat_id = None
         
+        # Owners are resolved through the client's userID -> chat index, one /users fetch for all of them
         if user_id:
-            u = self.catalog.get(f"/users/{user_id}")
-            if u: target_chat_id = u.get('telegram_chat_id')
+            target_chat_id = self.catalog.get_chat_id_by_user(user_id)
         
-        elif device_id:
-            d = self.catalog.get(f"/devices/{device_id}")
-            if d and d.get('owner'):
-                owner_id = d['owner']
-                u = self.catalog.get(f"/users/{owner_id}")
-                if u: target_chat_id = u.get('telegram_chat_id')
+        elif device and device.get('owner'):
+            target_chat_id = self.catalog.get_chat_id_by_user(device['owner'])
         
         if not target_chat_id:
             print(f"[ALERT] Could not find target chat for alert. (Dev: {device_id}, User: {user_id})")
@@ -155,15 +298,10 @@ class TelegramBotService:
         # 2. Cooldown Logic
         now = time.time()
         alert_key = f"{target_chat_id}_{alert_type}_{device_id}"
-        last_time = self.last_alert_time.get(alert_key, 0)
-        cooldown_sec = self.settings.get("defaults", {}).get("alert_cooldown_minutes", 15) * 60
         
-        is_door_closed_event = (str(alert_type).lower() == 'doorclosed') or ('door_closed' in str(alert_type).lower())
-
-        # Skip if cooldown active
-        if not is_door_closed_event and (now - last_time < cooldown_sec):
-            print(f"[ALERT] Cooldown active for {alert_key}. Skipping.")
-            return
+        alert_name = str(alert_type)
+        alert_name_lc = alert_name.lower()
+        is_door_closed_event = (alert_name_lc == 'doorclosed') or ('door_closed' in alert_name_lc)
 
         # 3. Send Message
         try:
@@ -174,27 +312,102 @@ class TelegramBotService:
                 duration = payload.get('duration_seconds')
                 dur_text = f" after {duration:.0f}s" if duration else ""
                 body = f"\nThe fridge door was closed{dur_text}."
-                severity_icon = "" # No severity icon for info
             else:
-                icon = "🚨" if severity == "critical" else ("⚠️" if severity == "warning" else "ℹ️")
-                title = f"{str(alert_type).replace('_', ' ').title()} Alert"
+                icon = SEVERITY_ICONS.get(severity, "ℹ️")
+                title = alert_title(alert_name)
                 body = f"*Details:* {msg_text}"
-                if payload.get('recommended_action'):
-                    body += f"\n*Suggestion:* {payload['recommended_action']}"
+                recommended_action = payload.get('recommended_action')
+                if recommended_action:
+                    body += f"\n*Suggestion:* {recommended_action}"
             
-            full_msg = f"{icon}* - {title}*\n\n"
-            if device_id: full_msg += f"*Device:* {device_nick}\n`(ID: {device_id})`\n"
-            full_msg += body
+            device_text = ALERT_DEVICE_TEMPLATE.format(nick=device_nick, device_id=device_id) if device_id else ""
+            full_msg = ALERT_TEMPLATE.format(icon=icon, title=title, device=device_text, body=body)
 
-            self.bot.sendMessage(int(target_chat_id), full_msg, parse_mode="Markdown")
-            print(f"[ALERT] Sent '{alert_type}' to {target_chat_id}")
-
-            # Update cooldown timestamp
+            # Check and update the cooldown in one step, so of two alerts processed at once only one passes.
+            # Updated now, so alerts processed while this one is in flight are skipped.
             if not is_door_closed_event:
-                self.last_alert_time[alert_key] = now
+                with self.pending_alerts_lock:
+                    if now - self.last_alert_time.get(alert_key, 0) < self.alert_cooldown_sec:
+                        print(f"[ALERT] Cooldown active for {alert_key}. Skipping.")
+                        return
+                    self.last_alert_time[alert_key] = now
+
+            self._queue_alert(int(target_chat_id), full_msg, alert_type, alert_key, now)
+
+        except Exception as e:
+            print(f"[ALERT] Failed to prepare Telegram message: {e}")
+
+    def _queue_alert(self, chat_id, text, alert_type, alert_key, sent_at):
+        """
+        Buffers an alert for its chat. Alerts for the same chat arriving within
+        ALERT_BATCH_WINDOW seconds are sent as a single Telegram message.
+        """
+        with self.pending_alerts_lock:
+            batch = self.pending_alerts.setdefault(chat_id, [])
+            batch.append((text, alert_type, alert_key, sent_at))
+            batch_size = len(batch)
+
+        if self.stop_event.is_set():
+            # Shutting down: the sender pool may be gone, send from this thread
+            self._flush_alerts(chat_id)
+        elif batch_size >= ALERT_BATCH_MAX:
+            self._submit_flush(chat_id)
+        elif batch_size == 1:
+            # The timer only waits out the window: the send itself runs on the sender pool
+            timer = threading.Timer(ALERT_BATCH_WINDOW, self._submit_flush, args=(chat_id,))
+            timer.daemon = True
+            timer.start()
+
+    def _submit_flush(self, chat_id):
+        """Hands a chat's pending alerts to the sender pool."""
+        try:
+            self.alert_sender.submit(self._flush_alerts, chat_id)
+        except RuntimeError:
+            # Pool already shut down: stop() flushed every chat pending by then, later alerts are sent inline
+            pass
+
+    def _flush_alerts(self, chat_id):
+        """Sends the buffered alerts of a chat, within Telegram's bot-wide rate limit."""
+        with self.pending_alerts_lock:
+            batch = self.pending_alerts.pop(chat_id, None)
+        if not batch:
+            return
 
+        alert_types = ", ".join(str(alert_type) for _, alert_type, _, _ in batch)
+        try:
+            self.send_bot.sendMessage(chat_id, "\n\n".join(text for text, _, _, _ in batch), parse_mode="Markdown")
+            print(f"[ALERT] Sent {len(batch)} alert(s) '{alert_types}' to {chat_id}")
+            return
+        except telepot.exception.TelegramError as e:
+            if not _is_markdown_error(e):
+                self._alerts_not_sent(batch, e)
+                return
+            print(f"[ALERT] Markdown rejected for {chat_id}, sending the {len(batch)} alert(s) one by one")
         except Exception as e:
-            print(f"[ALERT] Failed to send Telegram message: {e}")
+            self._alerts_not_sent(batch, e)
+            return
+
+        # One bad entity (e.g. a '_' in a device name) fails the whole batch: send each alert on
+        # its own, and the ones Telegram still cannot parse as plain text
+        for entry in batch:
+            text = entry[0]
+            try:
+                try:
+                    self.send_bot.sendMessage(chat_id, text, parse_mode="Markdown")
+                except telepot.exception.TelegramError as e:
+                    if not _is_markdown_error(e):
+                        raise
+                    self.send_bot.sendMessage(chat_id, text)
+            except Exception as e:
+                self._alerts_not_sent([entry], e)
+
+    def _alerts_not_sent(self, entries, error):
+        print(f"[ALERT] Failed to send Telegram message: {error}")
+        # Not delivered: do not hold back the next alerts of these kinds
+        with self.pending_alerts_lock:
+            for _, _, alert_key, sent_at in entries:
+                if self.last_alert_time.get(alert_key) == sent_at:
+                    self.last_alert_time.pop(alert_key, None)
 
     # --- Telegram Polling & Routing ---
 
@@ -202,57 +415,129 @@ class TelegramBotService:
         """Routes text messages to Commands or State Handlers."""
         chat_id = msg['chat']['id']
         text = msg.get('text', '').strip()
+        # Only commands are ever tokenized, plain text goes to state handlers untouched
+        is_command = text[:1] == '/'
         
         # 1. Check if user is in a specific STATE (waiting for input)
         status = self.handlers.get_status(chat_id)
         if status:
-            state_name = status['state']
+            state_name = status.state
             handler = self.handlers.state_handlers.get(state_name)
             
             # If user types a command while in a state, prioritize command (except cancel)
-            if text.startswith('/') and not text.startswith('/cancel'):
+            if is_command and not text.startswith('/cancel'):
                 pass # Let it fall through to command check
             elif handler:
-                print(f"[ROUTER] Routing to state handler: {state_name}")
-                handler(chat_id, msg, status['data'])
+                if self.debug:
+                    print(f"[ROUTER] Routing to state handler: {state_name}")
+                handler(chat_id, msg, status.data)
                 return
             else:
                 print(f"[ROUTER] No handler found for state {state_name}")
                 self.handlers.clear_status(chat_id)
 
         # 2. Check Commands
-        if text.startswith('/'):
-            parts = text.split()
-            cmd = parts[0].lower()
-            if cmd in self.handlers.commands:
-                print(f"[ROUTER] Routing to command: {cmd}")
-                self.handlers.commands[cmd](chat_id, msg)
+        if is_command:
+            # Only the command token is needed: split once, lowercase only when the exact token is unknown
+            cmd = text.split(None, 1)[0]
+            command = self.handlers.commands.get(cmd)
+            if command is None:
+                cmd = cmd.lower()
+                command = self.handlers.commands.get(cmd)
+            if command:
+                if self.debug:
+                    print(f"[ROUTER] Routing to command: {cmd}")
+                command(chat_id, msg)
             else:
-                self.bot.sendMessage(chat_id, "Unknown command. Try /help.")
+                self.send_bot.sendMessage(chat_id, "Unknown command. Try /help.")
         else:
             if not status:
-                self.bot.sendMessage(chat_id, "I don't understand. Use /help to see commands.")
+                self.send_bot.sendMessage(chat_id, "I don't understand. Use /help to see commands.")
 
     def _route_callback(self, msg_query):
         """Routes callback queries (button clicks)."""
-        query_id, chat_id, data = telepot.glance(msg_query, flavor='callback_query')
+        # Same fields telepot.glance(flavor='callback_query') returns, read directly
+        query_id, chat_id, data = msg_query['id'], msg_query['from']['id'], msg_query.get('data', '')
         
-        # "callback_key arg1 arg2"
-        parts = data.split()
-        key = parts[0]
-        args = parts[1:]
+        # "callback_key arg1 arg2": args are single tokens (device IDs, field names), passed positionally
+        key, _, rest = data.partition(" ")
+        handler = self.handlers.callbacks.get(key)
         
-        if key in self.handlers.callbacks:
-            print(f"[ROUTER] Routing callback: {key} args={args}")
-            self.handlers.callbacks[key](query_id, chat_id, msg_query, *args)
+        if handler:
+            # Most buttons carry no args or a single one: only split when there is more
+            args = rest.split() if " " in rest else ((rest,) if rest else ())
+            if self.debug:
+                print(f"[ROUTER] Routing callback: {key} args={args}")
+            handler(query_id, chat_id, msg_query, *args)
         else:
             print(f"[ROUTER] Unknown callback: {key}")
-            self.bot.answerCallbackQuery(query_id, text="Unknown action.")
+            self.send_bot.answerCallbackQuery(query_id, text="Unknown action.")
+
+    def _dispatch_update(self, update):
+        """Routes a single Telegram update to the matching handler."""
+        # 1. Handle Status Updates (Block/Unblock/Group)
+        if 'my_chat_member' in update:
+            self.handlers.handle_my_chat_member(update['my_chat_member'])
+
+        # 2. Handle Messages
+        elif 'message' in update:
+            self._route_message(update['message'])
+
+        # 3. Handle Callbacks
+        elif 'callback_query' in update:
+            self._route_callback(update['callback_query'])
+
+    @staticmethod
+    def _update_chat_id(update):
+        """Chat an update belongs to, used to key its pending updates."""
+        body = update.get('message') or update.get('callback_query') or update.get('my_chat_member')
+        if not body:
+            return None
+        # Callback queries carry the chat in the message their button belongs to
+        source = body.get('message') or body
+        chat = source.get('chat') or body.get('from') or {}
+        return chat.get('id')
+
+    def _enqueue_update(self, update):
+        """Queues an update behind its chat's pending ones; starts a drain task if the chat is idle."""
+        chat_id = self._update_chat_id(update)
+        with self.chat_updates_lock:
+            pending = self.chat_updates.get(chat_id)
+            if pending is not None:
+                pending.append(update)
+                return
+            self.chat_updates[chat_id] = deque((update,))
+        self.update_pool.submit(self._drain_chat, chat_id)
+
+    def _drain_chat(self, chat_id):
+        """Processes a chat's updates in arrival order, until none are left."""
+        while True:
+            with self.chat_updates_lock:
+                pending = self.chat_updates[chat_id]
+                if not pending:
+                    del self.chat_updates[chat_id]
+                    return
+                update = pending.popleft()
+            try:
+                self._dispatch_update(update)
+            except Exception as e:
+                print(f"[POLLING] Handler error on update {update.get('update_id')}: {e}")
+                self._notify_handler_error(update)
+
+    def _notify_handler_error(self, update):
+        """Tells the user their request failed instead of leaving it unanswered."""
+        chat_id = self._update_chat_id(update)
+        if chat_id is None or 'my_chat_member' in update:
+            return
+        try:
+            self.send_bot.sendMessage(chat_id, "⚠️ Something went wrong while handling your request. Please try again.")
+        except Exception as e:
+            print(f"[POLLING] Could not notify chat {chat_id}: {e}")
 
     def start_telegram_loop(self):
         """Starts the custom polling loop."""
         print("[INIT] Starting Telegram polling loop...")
-        
+
         def loop():
             offset = None
             while self.running:
@@ -261,24 +546,12 @@ class TelegramBotService:
                     updates = self.bot.getUpdates(offset=offset, timeout=20)
                     for update in updates:
                         offset = update['update_id'] + 1
-                        
-                        # 1. Handle Status Updates (Block/Unblock/Group)
-                        if 'my_chat_member' in update:
-                            self.handlers.handle_my_chat_member(update['my_chat_member'])
-                            continue
-                            
-                        # 2. Handle Messages
-                        if 'message' in update:
-                            self._route_message(update['message'])
-                            
-                        # 3. Handle Callbacks
-                        elif 'callback_query' in update:
-                            self._route_callback(update['callback_query'])
+                        self._enqueue_update(update)
                             
                 except Exception as e:
                     if self.running:
                         print(f"[POLLING] Error: {e}")
-                        time.sleep(3)
+                        self.stop_event.wait(3)
         
         self.message_loop_thread = threading.Thread(target=loop, daemon=True)
         self.message_loop_thread.start()
@@ -286,13 +559,16 @@ class TelegramBotService:
 
     # --- Lifecycle ---
 
+    @property
+    def running(self):
+        return not self.stop_event.is_set()
+
     def periodic_registration(self):
         """Background thread for keeping service alive in Catalog."""
         interval = self.settings.get("catalog", {}).get("registration_interval_seconds", 300)
-        while self.running:
-            time.sleep(interval)
-            if self.running:
-                self.catalog.register_service(self.service_info)
+        # wait() returns True as soon as stop() is called
+        while not self.stop_event.wait(interval):
+            self.catalog.register_service(self.service_info)
 
     def run(self):
         print("=" * 60)
@@ -315,15 +591,29 @@ class TelegramBotService:
         
         print("[INFO] Bot is running. Press CTRL+C to stop.")
         try:
-            while self.running:
-                time.sleep(1)
+            # Sleeps without periodic wake-ups until stop() sets the event
+            self.stop_event.wait()
         except KeyboardInterrupt:
             print("\n[SHUTDOWN] Interrupt received.")
             self.stop()
 
     def stop(self):
         print("[SHUTDOWN] Stopping service...")
-        self.running = False
+        self.stop_event.set()
+        self.update_pool.shutdown(wait=False, cancel_futures=True)
         if self.connected_mqtt:
             self.mqtt_client.stop()
+        self.mqtt_queue.put(None)
+        # Let the worker finish the messages already queued, so their alerts are in the snapshot below
+        if self.mqtt_worker_thread:
+            self.mqtt_worker_thread.join(timeout=10)
+        # Alerts still waiting for their batch window go out now; wait for the sender so none are dropped
+        with self.pending_alerts_lock:
+            waiting_chats = list(self.pending_alerts)
+        for chat_id in waiting_chats:
+            self._submit_flush(chat_id)
+        self.alert_sender.shutdown(wait=True)
+        self.handlers.lookups.shutdown(wait=False)
+        self.callback_answers.shutdown(wait=False)
+        self.catalog.close()
         print("[SHUTDOWN] Bye.")
\ No newline at end of file
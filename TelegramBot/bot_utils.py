@@ -1,17 +1,33 @@
 import re
+import sys
 import json
+import time
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional
 
+# Compiled once at import, reused by the validators on every message
+_MAC_STRIP_RE = re.compile(r"[^0-9A-Fa-f]")
+_USERNAME_RE = re.compile(r"\A[A-Za-z0-9_.-]{3,32}\Z")
+
+@lru_cache(maxsize=256)
 def normalize_mac(s: str) -> str:
     """Rimuove separatori e rende maiuscolo il MAC address."""
-    return re.sub(r"[^0-9A-Fa-f]", "", (s or "")).upper()
+    return _MAC_STRIP_RE.sub("", (s or "")).upper()
 
 def is_valid_mac(s: str) -> bool:
     """Verifica se il MAC è valido (12 caratteri esadecimali)."""
+    s = s or ""
+    # 12 hex digits, plus at most 11 separators: reject other lengths without the regex
+    n = len(s)
+    if n < 12 or n > 23:
+        return False
     return len(normalize_mac(s)) == 12
 
 def is_valid_username(s: str) -> bool:
     """Verifica formato username (3-32 caratteri alfanumerici)."""
-    return bool(re.fullmatch(r"[A-Za-z0-9_.-]{3,32}", s or ""))
+    return _USERNAME_RE.match(s or "") is not None
 
 def escape_markdown(text):
     """Esegue l'escape dei caratteri speciali per Markdown V2 di Telegram."""
@@ -24,21 +40,45 @@ def escape_markdown(text):
         text = text.replace(char, '\\' + char)
     return text
 
+class RateLimiter:
+    """Token bucket thread-safe: al massimo `rate` operazioni ogni `per` secondi, `burst` di fila."""
+
+    def __init__(self, rate, per=1.0, burst=None):
+        self.rate = rate
+        self.per = per
+        # Bucket size: how many operations may go out back to back after an idle period
+        self.burst = burst or rate
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Attende finché è disponibile un token e lo consuma."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate / self.per)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
+
 def load_settings(filename):
     """Carica e valida il file settings.json."""
     try:
-        with open(filename, 'r') as f:
-            settings_data = json.load(f)
-            
-            # validation
-            if "telegram" not in settings_data or "TOKEN" not in settings_data["telegram"]:
-                raise ValueError("Missing 'telegram' or 'TOKEN' in settings.")
-            if "catalog" not in settings_data or "url" not in settings_data["catalog"]:
-                raise ValueError("Missing 'catalog' or 'url' in settings.")
-            if "mqtt" not in settings_data or "brokerIP" not in settings_data["mqtt"] or "brokerPort" not in settings_data["mqtt"]:
-                raise ValueError("Missing 'mqtt' config (brokerIP, brokerPort) in settings.")
-                
-            return settings_data
+        settings_data = json.loads(Path(filename).read_bytes())
+
+        # validation
+        if "telegram" not in settings_data or "TOKEN" not in settings_data["telegram"]:
+            raise ValueError("Missing 'telegram' or 'TOKEN' in settings.")
+        if "catalog" not in settings_data or "url" not in settings_data["catalog"]:
+            raise ValueError("Missing 'catalog' or 'url' in settings.")
+        if "mqtt" not in settings_data or "brokerIP" not in settings_data["mqtt"] or "brokerPort" not in settings_data["mqtt"]:
+            raise ValueError("Missing 'mqtt' config (brokerIP, brokerPort) in settings.")
+
+        return settings_data
     except FileNotFoundError:
         print(f"[ERROR] Settings file '{filename}' not found.")
         raise
@@ -46,89 +86,99 @@ def load_settings(filename):
         print(f"[ERROR] Invalid or incomplete settings file '{filename}': {e}")
         raise
 
+class SettingSpec(NamedTuple):
+    """Metadati UI di una impostazione configurabile."""
+    name: str
+    desc: str
+    range_text: str
+    min: Optional[float]
+    max: Optional[float]
+    type: type
+    true_text: Optional[str] = None
+    false_text: Optional[str] = None
+
+_SETTINGS_MAP = {
+    # --- TimerUsageControl Settings ---
+    "max_door_open_seconds": SettingSpec(
+        name="Door Open Timeout",
+        desc="Maximum duration the door can remain open before triggering an alert.",
+        range_text="(30-300 seconds)",
+        min=30, max=300, type=int
+    ),
+    "check_interval": SettingSpec(
+        name="Check Interval",
+        desc="Frequency of monitoring checks for door violations.",
+        range_text="(1-30 seconds)",
+        min=1, max=30, type=int
+    ),
+    "enable_door_closed_alerts": SettingSpec(
+        name="Door Closed Alerts",
+        desc="Send notification when door closes after exceeding timeout.",
+        range_text="(Enabled/Disabled)",
+        min=None, max=None, type=bool,
+        true_text="Enabled",
+        false_text="Disabled"
+    ),
+
+    # --- FoodSpoilageControl Settings ---
+    "gas_threshold_ppm": SettingSpec(
+        name="Gas Level Threshold",
+        desc="Gas concentration level that triggers spoilage alerts.",
+        range_text="(100-1000 PPM)",
+        min=100, max=1000, type=int
+    ),
+    "alert_cooldown_minutes": SettingSpec(
+        name="Alert Cooldown Period",
+        desc="Minimum time between consecutive alerts to prevent spam.",
+        range_text="(5-120 minutes)",
+        min=5, max=120, type=int
+    ),
+    "enable_continuous_alerts": SettingSpec(
+        name="Alert Frequency",
+        desc="Configure how and when spoilage alerts are triggered.",
+        range_text="(On Breach Only / Continuous)",
+        min=None, max=None, type=bool,
+        true_text="Continuous while above threshold",
+        false_text="On Breach Only"
+    ),
+
+    # --- FridgeStatusControl Settings ---
+    "temp_min_celsius": SettingSpec(
+        name="Minimum Temperature",
+        desc="Acceptable temperature range lower bound.",
+        range_text="(-5 to 5 °C)",
+        min=-5, max=5, type=float
+    ),
+    "temp_max_celsius": SettingSpec(
+        name="Maximum Temperature",
+        desc="Acceptable temperature range upper bound.",
+        range_text="(5 to 15 °C)",
+        min=5, max=15, type=float
+    ),
+    "humidity_max_percent": SettingSpec(
+        name="Humidity Threshold",
+        desc="Maximum humidity level before triggering malfunction alerts.",
+        range_text="(50-95 %)",
+        min=50, max=95, type=float
+    ),
+    "enable_malfunction_alerts": SettingSpec(
+        name="Malfunction Alerts",
+        desc="Control when malfunction alerts are sent.",
+        range_text="(Enabled/Disabled)",
+        min=None, max=None, type=bool,
+        true_text="Enabled",
+        false_text="Disabled"
+    )
+}
+
 def get_setting_details(field_name):
     """
     Restituisce i dettagli completi per la UI di ogni impostazione.
     Include Nome, Descrizione e Range visuale per mantenere l'output originale.
     """
-    settings_map = {
-        # --- TimerUsageControl Settings ---
-        "max_door_open_seconds": {
-            "name": "Door Open Timeout",
-            "desc": "Maximum duration the door can remain open before triggering an alert.",
-            "range_text": "(30-300 seconds)",
-            "min": 30, "max": 300, "type": int
-        },
-        "check_interval": {
-            "name": "Check Interval",
-            "desc": "Frequency of monitoring checks for door violations.",
-            "range_text": "(1-30 seconds)",
-            "min": 1, "max": 30, "type": int
-        },
-        "enable_door_closed_alerts": {
-            "name": "Door Closed Alerts",
-            "desc": "Send notification when door closes after exceeding timeout.",
-            "range_text": "(Enabled/Disabled)",
-            "type": bool,
-            "true_text": "Enabled",
-            "false_text": "Disabled"
-        },
-        
-        # --- FoodSpoilageControl Settings ---
-        "gas_threshold_ppm": {
-            "name": "Gas Level Threshold",
-            "desc": "Gas concentration level that triggers spoilage alerts.",
-            "range_text": "(100-1000 PPM)",
-            "min": 100, "max": 1000, "type": int
-        },
-        "alert_cooldown_minutes": {
-            "name": "Alert Cooldown Period",
-            "desc": "Minimum time between consecutive alerts to prevent spam.",
-            "range_text": "(5-120 minutes)",
-            "min": 5, "max": 120, "type": int
-        },
-        "enable_continuous_alerts": {
-            "name": "Alert Frequency",
-            "desc": "Configure how and when spoilage alerts are triggered.",
-            "range_text": "(On Breach Only / Continuous)",
-            "type": bool,
-            "true_text": "Continuous while above threshold",
-            "false_text": "On Breach Only"
-        },
-        
-        # --- FridgeStatusControl Settings ---
-        "temp_min_celsius": {
-            "name": "Minimum Temperature",
-            "desc": "Acceptable temperature range lower bound.",
-            "range_text": "(-5 to 5 °C)",
-            "min": -5, "max": 5, "type": float
-        },
-        "temp_max_celsius": {
-            "name": "Maximum Temperature",
-            "desc": "Acceptable temperature range upper bound.",
-            "range_text": "(5 to 15 °C)",
-            "min": 5, "max": 15, "type": float
-        },
-        "humidity_max_percent": {
-            "name": "Humidity Threshold",
-            "desc": "Maximum humidity level before triggering malfunction alerts.",
-            "range_text": "(50-95 %)",
-            "min": 50, "max": 95, "type": float
-        },
-        "enable_malfunction_alerts": {
-            "name": "Malfunction Alerts",
-            "desc": "Control when malfunction alerts are sent.",
-            "range_text": "(Enabled/Disabled)",
-            "type": bool,
-            "true_text": "Enabled", 
-            "false_text": "Disabled"
-        }
-    }
-    
-    # base dict if the key doesnt exist
-    return settings_map.get(field_name, {
-        "name": field_name, 
-        "desc": "", 
-        "range_text": "", 
-        "type": "unknown"
-    })
\ No newline at end of file
+    # field_name usually comes from parsed callback_data: intern it so the lookup compares by identity
+    spec = _SETTINGS_MAP.get(sys.intern(field_name))
+    if spec is None:
+        # base spec if the key doesnt exist
+        spec = SettingSpec(name=field_name, desc="", range_text="", min=None, max=None, type=str)
+    return spec
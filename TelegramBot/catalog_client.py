@@ -1,33 +1,82 @@
 import time
 import re
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone
 
+# Compiled once: the fallback MAC scan runs it on every device in the catalog
+_NON_HEX_RE = re.compile(r'[^0-9A-Fa-f]')
+
 class CatalogError(Exception):
     """Custom exception for Catalog API errors."""
-    def __init__(self, message, status_code=500):
+    def __init__(self, message, status_code=500, detail=None):
         super().__init__(message)
         self.status_code = status_code
+        # Parsed JSON error body, when the catalog sent one
+        self.detail = detail
 
 class CatalogClient:
-    def __init__(self, catalog_url):
+    USER_CACHE_TTL = 30  # seconds a chat -> user lookup is reused
+    UNKNOWN_CHAT_TTL = 10  # seconds a chat with no linked user is answered without a fetch
+    GET_CACHE_MAX_ENTRIES = 256  # expired GET entries are pruned past this size
+
+    def __init__(self, catalog_url, pool_maxsize=8):
         self.catalog_url = catalog_url
 
-    def request(self, method, path, json_data=None, timeout=6):
+        # {chat_id: (expiry, user)}, {userID: (expiry, chat_id)} and {path: (expiry, body, etag)},
+        # cleared by any write to the catalog
+        self._user_cache = {}
+        self._chat_by_user = {}
+        self._get_cache = {}
+        # Guards the caches' multi-step updates: every bot thread shares this client
+        self._cache_lock = threading.Lock()
+
+        # Shared keep-alive session: catalog calls reuse pooled connections instead of opening a new socket each time
+        self.http = requests.Session()
+        # Transient failures are retried with a short backoff. Status and read retries are limited
+        # to idempotent methods, POSTs are only retried when the connection could not be opened.
+        retries = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset({"GET", "DELETE"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retries)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.http.headers.update({"Connection": "keep-alive"})
+
+    def close(self):
+        """Releases the pooled connections."""
+        self.http.close()
+
+    def request(self, method, path, json_data=None, timeout=(1, 3)):
         """
         Generic HTTP request handler with error mapping.
         Replicates the original 'catalog_request' function logic.
         """
+        r = self._send(method, path, json_data, timeout)
+        return r.json() if r.content else {}
+
+    def _send(self, method, path, json_data=None, timeout=(1, 3), extra_headers=None):
+        """Sends the request and maps HTTP/connection errors to CatalogError. Returns the response."""
         url = f"{self.catalog_url}{path}"
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        if extra_headers:
+            headers.update(extra_headers)
         
         try:
-            r = requests.request(method, url, json=json_data, headers=headers, timeout=timeout)
+            r = self.http.request(method, url, json=json_data, headers=headers, timeout=timeout)
+            if method != "GET":
+                # Users or their device lists may have changed
+                with self._cache_lock:
+                    self._user_cache.clear()
+                    self._chat_by_user.clear()
+                    self._get_cache.clear()
             r.raise_for_status()
-            return r.json() if r.content else {}
+            return r
             
         except requests.exceptions.HTTPError as e:
             status_code = e.response.status_code
+            detail_json = None
             try:
                 # Try to parse error message from JSON response
                 detail_json = r.json()
@@ -36,14 +85,40 @@ class CatalogClient:
                 # Fallback to text
                 error_msg = r.text
             
-            raise CatalogError(f"{method} {path} -> HTTP {status_code}: {error_msg}", status_code) from e
+            raise CatalogError(f"{method} {path} -> HTTP {status_code}: {error_msg}", status_code,
+                               detail_json if isinstance(detail_json, dict) else None) from e
             
         except requests.RequestException as e:
             raise CatalogError(f"{method} {path} failed: {e}")
 
     # --- HTTP Method Wrappers ---
-    def get(self, path): 
-        return self.request("GET", path)
+    def get(self, path, max_age=0):
+        """
+        GET path. With max_age > 0 a response up to max_age seconds old may be reused;
+        once it expires it is revalidated with its ETag, and a 304 keeps the cached body.
+        """
+        if max_age <= 0:
+            return self.request("GET", path)
+
+        cached = self._get_cache.get(path)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        etag = cached[2] if cached else None
+        r = self._send("GET", path, extra_headers={"If-None-Match": etag} if etag else None)
+        if r.status_code == 304:
+            data = cached[1]
+        else:
+            data = r.json() if r.content else {}
+            etag = r.headers.get("ETag")
+
+        now = time.monotonic()
+        with self._cache_lock:
+            if len(self._get_cache) >= self.GET_CACHE_MAX_ENTRIES:
+                # Drop expired entries so paths that are not read again do not pile up
+                self._get_cache = {p: entry for p, entry in self._get_cache.items() if entry[0] > now}
+            self._get_cache[path] = (now + max_age, data, etag)
+        return data
 
     def post(self, path, data): 
         return self.request("POST", path, json_data=data)
@@ -71,7 +146,7 @@ class CatalogClient:
 
         for attempt in range(max_retries):
             try:
-                r = requests.post(f"{self.catalog_url}/services/register", json=payload, timeout=5)
+                r = self.http.post(f"{self.catalog_url}/services/register", json=payload, timeout=5)
                 if r.status_code in (200, 201):
                     print("[REGISTER] Registered with Catalog")
                     return True
@@ -88,17 +163,28 @@ class CatalogClient:
     def find_device_by_mac(self, raw_mac):
         """
         Replicates '_find_device_by_mac'. 
-        Fetches all devices and compares normalized MACs.
+        The catalog derives device IDs from the MAC ('SmartChill_<MAC>'), so the
+        device is fetched directly; the full device list is only scanned as a fallback.
         """
         try:
             # Normalize input MAC
-            target_mac = re.sub(r'[^0-9A-Fa-f]', '', raw_mac).upper()
+            target_mac = _NON_HEX_RE.sub('', raw_mac).upper()
+
+            try:
+                device = self.get(f"/devices/SmartChill_{target_mac}")
+                if device and _NON_HEX_RE.sub('', device.get('mac_address', '')).upper() == target_mac:
+                    print(f"[CATALOG] Found device by MAC {raw_mac}: {device.get('deviceID')}")
+                    return device
+            except CatalogError as e:
+                if e.status_code != 404:
+                    raise
             
-            devices = self.get("/devices")
+            # Filtered by the catalog; the check below keeps working against catalogs without the filter
+            devices = self.get(f"/devices?mac_address={target_mac}")
             for device in devices:
                 # Normalize device MAC from catalog
                 dev_mac_raw = device.get('mac_address', '')
-                dev_mac = re.sub(r'[^0-9A-Fa-f]', '', dev_mac_raw).upper()
+                dev_mac = _NON_HEX_RE.sub('', dev_mac_raw).upper()
                 
                 if dev_mac == target_mac:
                     print(f"[CATALOG] Found device by MAC {raw_mac}: {device.get('deviceID')}")
@@ -114,17 +200,67 @@ class CatalogClient:
             print(f"[ERROR] Unexpected error in find_device_by_mac: {e}")
             return None
 
+    def _load_user_index(self):
+        """
+        Fetches all users and indexes them by telegram_chat_id and by userID, in the shared caches
+        too. Returns ({chat_id: user}, {userID: chat_id}) as built from this fetch, so
+        callers read their answer there rather than from caches other threads may change meanwhile.
+        """
+        users = self.get("/users")
+        by_chat, by_user = {}, {}
+        for user in users:
+            linked_chat = user.get('telegram_chat_id')
+            # Users without a chat are indexed too, so their alerts do not refetch the list
+            by_user[user.get('userID')] = linked_chat
+            if linked_chat is not None:
+                by_chat[str(linked_chat)] = user
+        expiry = time.monotonic() + self.USER_CACHE_TTL
+        self._chat_by_user.update((uid, (expiry, chat)) for uid, chat in by_user.items())
+        self._user_cache.update((chat, (expiry, user)) for chat, user in by_chat.items())
+        return by_chat, by_user
+
     def get_user_by_chat_id(self, chat_id):
         """
         Replicates '_is_registered'.
-        Fetches all users and looks for a matching telegram_chat_id.
+        Fetches all users and indexes them by telegram_chat_id, so one fetch
+        answers the lookups of every linked chat for USER_CACHE_TTL seconds.
+        A chat with no user is remembered for UNKNOWN_CHAT_TTL seconds.
         """
+        key = str(chat_id)
+        cached = self._user_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
         try:
-            users = self.get("/users")
-            for user in users:
-                if str(user.get('telegram_chat_id')) == str(chat_id):
-                    return user
-            return None
+            by_chat, _ = self._load_user_index()
         except CatalogError as e:
             print(f"[ERROR] Failed to check registration: {e}")
-            return None
\ No newline at end of file
+            return None
+        user = by_chat.get(key)
+        if user is None:
+            # Unregistered chats keep tapping menus: skip the /users fetch for a while.
+            # Registering or linking is a write, which clears this entry.
+            now = time.monotonic()
+            with self._cache_lock:
+                # A newer fetch by another thread may have found the chat meanwhile: keep that answer
+                current = self._user_cache.get(key)
+                if not (current and current[1] is not None and current[0] > now):
+                    self._user_cache[key] = (now + self.UNKNOWN_CHAT_TTL, None)
+        return user
+
+    def get_chat_id_by_user(self, user_id):
+        """
+        Telegram chat linked to a user, or None.
+        Served from the same /users index as get_user_by_chat_id, so alerts for
+        any user need no per-user request while the index is fresh.
+        """
+        cached = self._chat_by_user.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        try:
+            _, by_user = self._load_user_index()
+        except CatalogError as e:
+            print(f"[ERROR] Failed to look up chat of user {user_id}: {e}")
+            return None
+        return by_user.get(user_id)
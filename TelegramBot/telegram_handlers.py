@@ -1,6 +1,10 @@
+import math
+import threading
 import telepot
-from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
+from dataclasses import dataclass
 from bot_utils import (
     is_valid_mac, 
     is_valid_username, 
@@ -8,16 +12,90 @@ from bot_utils import (
     escape_markdown, 
     get_setting_details
 )
+from catalog_client import CatalogError
+
+# Keyboards are plain reply_markup dicts, so no InlineKeyboardMarkup/InlineKeyboardButton
+# namedtuples are constructed on each call (telepot still walks the dict before sending).
+# Static keyboard parts, built once and shared by every menu that shows them
+MYDEVICES_FOOTER_ROW = [
+    {"text": "➕ Add new device", "callback_data": "cb_newdevice_start"},
+    {"text": "Close menu", "callback_data": "cb_quit_menu"}
+]
+DEVICE_MENU_BACK_ROW = [{"text": "« Back", "callback_data": "cb_mydevices_back"}]
+DEVICE_MENU_CLOSE_ROW = [{"text": "Close Menu", "callback_data": "cb_quit_menu"}]
+SERVICE_BACK_ROW = [{"text": "« Back", "callback_data": "cb_service_menu_back"}]
+SERVICE_BACK_KEYBOARD = {"inline_keyboard": [SERVICE_BACK_ROW]}
+SERVICE_OPTIONS_ROWS = (
+    [{"text": "ℹ️ Show Current Info", "callback_data": "cb_show_current_info"}],
+    [{"text": "✏️ Modify Settings", "callback_data": "cb_service_modify"}]
+)
+EDIT_BOOLEAN_BACK_ROW = [{"text": "« Back", "callback_data": "cb_service_modify"}]
+
+# Services shown in a device's settings menu: (button label, serviceID)
+SETTINGS_SERVICES = (
+    ("⏱️ Door Timer", "TimerUsageControl"),
+    ("🔥 Food Spoilage", "FoodSpoilageControl"),
+    ("🌡️ Fridge Status", "FridgeStatusControl"),
+)
+
+@lru_cache(maxsize=32)
+def boolean_keyboard(field):
+    """True/False keyboard of a boolean setting. It only depends on the field, so it is built once."""
+    det = get_setting_details(field)
+    return {"inline_keyboard": [
+        [
+            {"text": f"✅ {det.true_text or 'True'}", "callback_data": f"cb_set_boolean {field} True"},
+            {"text": f"❌ {det.false_text or 'False'}", "callback_data": f"cb_set_boolean {field} False"}
+        ],
+        EDIT_BOOLEAN_BACK_ROW
+    ]}
+
+@dataclass(slots=True)
+class ChatState:
+    """Conversation state of a chat: the state name and the data collected so far."""
+    state: str
+    data: dict
+
+# Seconds a device/device-list read may be reused while the user navigates the menus.
+# Any write through the catalog client drops cached reads right away.
+MENU_READ_MAX_AGE = 5
+
+# States in which a chat waits for a config reply from a control service
+CONFIG_STATES = ("waiting_for_config", "waiting_for_new_value")
+
+START_SET_UP_TEXT = "You seem to be already set up.\nUse /mydevices or /help."
+START_MAC_PROMPT = (
+    "To link your SmartChill account, please enter the **MAC address** of your fridge.\n"
+    "(Format: `XX:XX:XX:XX:XX:XX` or `AABBCC112233`)"
+)
+
+HELP_TEXT = (
+    "Commands:\n"
+    "/start – Start menu\n"
+    "/newdevice – Add a new device\n"
+    "/mydevices – List your devices\n"
+    "/showme – Show account info\n"
+    "/deleteme – Delete account\n"
+    "/cancel – Cancel action"
+)
 
 class BotHandlers:
-    def __init__(self, bot, catalog_client, mqtt_client, config_template):
+    def __init__(self, bot, catalog_client, mqtt_client, config_template, debug=False):
         self.bot = bot
+        # State transition traces are printed only in debug mode
+        self.debug = debug
         self.catalog = catalog_client
         self.mqtt = mqtt_client
         self.config_template = config_template
         
-        # State Management: {chat_id: {"state": "name", "data": {...}}}
+        # State Management: {chat_id: ChatState}
         self.user_states = {} 
+        # Chats waiting for an MQTT config reply: {device_id: {chat_id, ...}}
+        self.config_waiters = {}
+        # Update workers (one per chat shard) and the MQTT worker change both maps
+        self._status_lock = threading.Lock()
+        # Runs independent catalog lookups of a handler side by side
+        self.lookups = ThreadPoolExecutor(max_workers=4, thread_name_prefix="catalog_lookup")
         
         # Command Mappings
         self.commands = {
@@ -61,21 +139,44 @@ class BotHandlers:
         }
 
     # --- Helper Methods ---
+    def _unindex_config_waiter(self, chat_id, state):
+        """Drops the device -> chat entry left by a config-waiting state."""
+        if state and state.state in CONFIG_STATES:
+            did = state.data.get("device_id")
+            chats = self.config_waiters.get(did)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self.config_waiters[did]
+
     def set_status(self, chat_id, state_name, **kwargs):
-        self.user_states[chat_id] = {"state": state_name, "data": kwargs}
-        print(f"[STATE] {chat_id} -> {state_name}")
+        with self._status_lock:
+            self._unindex_config_waiter(chat_id, self.user_states.get(chat_id))
+            self.user_states[chat_id] = ChatState(state_name, kwargs)
+            if state_name in CONFIG_STATES and kwargs.get("device_id") is not None:
+                # Several chats may configure the same device: each gets the replies
+                self.config_waiters.setdefault(kwargs["device_id"], set()).add(chat_id)
+        if self.debug:
+            print(f"[STATE] {chat_id} -> {state_name}")
 
     def get_status(self, chat_id):
         return self.user_states.get(chat_id)
 
     def clear_status(self, chat_id):
-        removed = self.user_states.pop(chat_id, None)
-        if removed:
-            print(f"[STATE] {chat_id} exit {removed['state']}")
+        with self._status_lock:
+            removed = self.user_states.pop(chat_id, None)
+            if removed:
+                self._unindex_config_waiter(chat_id, removed)
+        if removed and self.debug:
+            print(f"[STATE] {chat_id} exit {removed.state}")
         return removed
 
+    def _log_failure(self, action, chat_id, e):
+        """Logs why an action failed. Users get a fixed message, not the internal error."""
+        print(f"[ERROR] {action} failed for chat {chat_id}: {e}")
+
     def _get_username(self, msg):
-        u = msg.get("from", {})
+        u = msg.get("from") or {}
         return u.get("first_name") or u.get("username") or f"User_{u.get('id')}"
 
     # --- Command Handlers ---
@@ -86,29 +187,15 @@ class BotHandlers:
         
         user = self.catalog.get_user_by_chat_id(chat_id)
         if user and user.get("devicesList"):
-            self.bot.sendMessage(chat_id, "You seem to be already set up.\nUse /mydevices or /help.")
+            self.bot.sendMessage(chat_id, START_SET_UP_TEXT)
             self.clear_status(chat_id)
             return
             
-        self.bot.sendMessage(
-            chat_id,
-            "To link your SmartChill account, please enter the **MAC address** of your fridge.\n"
-            "(Format: `XX:XX:XX:XX:XX:XX` or `AABBCC112233`)",
-            parse_mode="Markdown"
-        )
+        self.bot.sendMessage(chat_id, START_MAC_PROMPT, parse_mode="Markdown")
         self.set_status(chat_id, "waiting_for_mac")
 
     def cmd_help(self, chat_id, msg, *args):
-        txt = (
-            "Commands:\n"
-            "/start – Start menu\n"
-            "/newdevice – Add a new device\n"
-            "/mydevices – List your devices\n"
-            "/showme – Show account info\n"
-            "/deleteme – Delete account\n"
-            "/cancel – Cancel action"
-        )
-        self.bot.sendMessage(chat_id, txt)
+        self.bot.sendMessage(chat_id, HELP_TEXT)
 
     def cmd_newdevice(self, chat_id, msg, *args):
         user = self.catalog.get_user_by_chat_id(chat_id)
@@ -129,7 +216,7 @@ class BotHandlers:
                 self.bot.sendMessage(chat_id, "You are not registered yet. Use /start to begin.")
                 return
             try:
-                devices = self.catalog.get(f"/users/{user['userID']}/devices")
+                devices = self.catalog.get(f"/users/{user['userID']}/devices", max_age=MENU_READ_MAX_AGE)
                 if not devices:
                     txt = "You have no devices yet. Use /newdevice to add one."
                     if message_to_edit:
@@ -141,14 +228,11 @@ class BotHandlers:
                 buttons = []
                 for d in devices:
                     name = d.get('user_device_name') or d.get('deviceID') or 'Unknown'
-                    buttons.append([InlineKeyboardButton(text=f"🧊 {name}", callback_data=f"cb_device_menu {d.get('deviceID')}")])
+                    buttons.append([{"text": f"🧊 {name}", "callback_data": f"cb_device_menu {d.get('deviceID')}"}])
                 
-                buttons.append([
-                    InlineKeyboardButton(text="➕ Add new device", callback_data="cb_newdevice_start"),
-                    InlineKeyboardButton(text="Close menu", callback_data="cb_quit_menu")
-                ])
+                buttons.append(MYDEVICES_FOOTER_ROW)
                 
-                keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+                keyboard = {"inline_keyboard": buttons}
                 text = "Your Devices:"
                 
                 if message_to_edit:
@@ -157,8 +241,8 @@ class BotHandlers:
                     self.bot.sendMessage(chat_id, text, reply_markup=keyboard)
                     
             except Exception as e:
-                print(f"Error: {e}")
-                self.bot.sendMessage(chat_id, f"⚠️ Failed to retrieve devices: {e}")
+                self._log_failure("Device list", chat_id, e)
+                self.bot.sendMessage(chat_id, "⚠️ Failed to retrieve devices. Please try again.")
 
     def cmd_showme(self, chat_id, msg, *args):
         user = self.catalog.get_user_by_chat_id(chat_id)
@@ -190,7 +274,8 @@ class BotHandlers:
             self.catalog.delete(f"/users/{uid}")
             self.bot.sendMessage(chat_id, f"User {user['userName']} deleted.\nDevices were unassigned.")
         except Exception as e:
-            self.bot.sendMessage(chat_id, f"❌ Deletion failed: {e}")
+            self._log_failure("Account deletion", chat_id, e)
+            self.bot.sendMessage(chat_id, "❌ Deletion failed. Please try again.")
 
     def cmd_cancel(self, chat_id, msg, *args):
         removed = self.clear_status(chat_id)
@@ -211,18 +296,18 @@ class BotHandlers:
         msg_id = telepot.message_identifier(msg_query['message'])
         
         buttons = [
-            [InlineKeyboardButton(text="ℹ️ Show Info", callback_data=f"cb_device_info {did}")],
-            [InlineKeyboardButton(text="✏️ Rename Device", callback_data=f"cb_device_rename {did}")],
-            [InlineKeyboardButton(text="⚙️ Settings", callback_data=f"cb_settings_menu {did}")],
-            [InlineKeyboardButton(text="❌ Unassign Device", callback_data=f"cb_device_unassign {did}")],
-            [InlineKeyboardButton(text="« Back", callback_data=f"cb_mydevices_back")],
-            [InlineKeyboardButton(text="Close Menu", callback_data="cb_quit_menu")]
+            [{"text": "ℹ️ Show Info", "callback_data": f"cb_device_info {did}"}],
+            [{"text": "✏️ Rename Device", "callback_data": f"cb_device_rename {did}"}],
+            [{"text": "⚙️ Settings", "callback_data": f"cb_settings_menu {did}"}],
+            [{"text": "❌ Unassign Device", "callback_data": f"cb_device_unassign {did}"}],
+            DEVICE_MENU_BACK_ROW,
+            DEVICE_MENU_CLOSE_ROW
         ]
         
         self.bot.editMessageText(
             msg_id, 
             f"Options for device `{escape_markdown(did)}`:", 
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            reply_markup={"inline_keyboard": buttons},
             parse_mode="Markdown"
         )
 
@@ -236,7 +321,7 @@ class BotHandlers:
         msg_id = telepot.message_identifier(msg_query['message'])
         
         try:
-            device = self.catalog.get(f"/devices/{did}")
+            device = self.catalog.get(f"/devices/{did}", max_age=MENU_READ_MAX_AGE)
             if not device:
                 self.bot.editMessageText(msg_id, "⚠️ Device not found.")
                 return
@@ -248,11 +333,12 @@ class BotHandlers:
                 f"🔢 - *MAC:* `{escape_markdown(device.get('mac_address', 'N/A'))}`\n"
             )
             
-            buttons = [[InlineKeyboardButton(text="« Back", callback_data=f"cb_device_menu {did}")]]
-            self.bot.editMessageText(msg_id, txt, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+            buttons = [[{"text": "« Back", "callback_data": f"cb_device_menu {did}"}]]
+            self.bot.editMessageText(msg_id, txt, parse_mode="Markdown", reply_markup={"inline_keyboard": buttons})
             
         except Exception as e:
-            self.bot.editMessageText(msg_id, f"Error: {e}")
+            self._log_failure("Device info", chat_id, e)
+            self.bot.editMessageText(msg_id, "⚠️ Could not load the device info. Please try again.")
 
     def cb_device_unassign(self, query_id, chat_id, msg_query, *args):
         did = args[0]
@@ -262,10 +348,10 @@ class BotHandlers:
         
         try:
             self.catalog.post(f"/devices/{did}/unassign", None)
-            self.bot.editMessageText(msg_id, f"Device `{escape_markdown(did)}` unassigned.", parse_mode="Markdown")
-            self.bot.sendMessage(chat_id, "Use /mydevices to refresh.")
+            self.bot.editMessageText(msg_id, f"Device `{escape_markdown(did)}` unassigned.\nUse /mydevices to refresh.", parse_mode="Markdown")
         except Exception as e:
-            self.bot.editMessageText(msg_id, f"❌ Failed: {e}")
+            self._log_failure("Device unassign", chat_id, e)
+            self.bot.editMessageText(msg_id, "❌ Failed to unassign the device. Please try again.")
 
     def cb_device_rename(self, query_id, chat_id, msg_query, *args):
         did = args[0]
@@ -273,7 +359,7 @@ class BotHandlers:
         msg_id = telepot.message_identifier(msg_query['message'])
         
         try:
-            d = self.catalog.get(f"/devices/{did}")
+            d = self.catalog.get(f"/devices/{did}", max_age=MENU_READ_MAX_AGE)
             curr = d.get('user_device_name', 'N/A')
         except: curr = "Unknown"
 
@@ -289,17 +375,13 @@ class BotHandlers:
         self.bot.answerCallbackQuery(query_id)
         msg_id = telepot.message_identifier(msg_query['message'])
         
-        buttons = [
-            [InlineKeyboardButton(text="⏱️ Door Timer", callback_data=f"cb_service_menu {did} TimerUsageControl")],
-            [InlineKeyboardButton(text="🔥 Food Spoilage", callback_data=f"cb_service_menu {did} FoodSpoilageControl")],
-            [InlineKeyboardButton(text="🌡️ Fridge Status", callback_data=f"cb_service_menu {did} FridgeStatusControl")],
-            [InlineKeyboardButton(text="« Back to Device", callback_data=f"cb_device_menu {did}")]
-        ]
+        buttons = [[{"text": label, "callback_data": f"cb_service_menu {did} {svc}"}] for label, svc in SETTINGS_SERVICES]
+        buttons.append([{"text": "« Back to Device", "callback_data": f"cb_device_menu {did}"}])
         self.bot.editMessageText(
             msg_id, 
             f"⚙️ **Settings**\nSelect a service for `{escape_markdown(did)}`:", 
             parse_mode="Markdown", 
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+            reply_markup={"inline_keyboard": buttons}
         )
 
     def cb_service_menu(self, query_id, chat_id, msg_query, *args):
@@ -319,18 +401,19 @@ class BotHandlers:
             self.mqtt.myPublish(topic, {"type": "config_get", "device_id": did})
             self.bot.editMessageText(msg_id, f"🔄 Fetching settings for *{escape_markdown(svc)}*...", parse_mode="Markdown")
         except Exception as e:
-            self.bot.editMessageText(msg_id, f"❌ MQTT Error: {e}")
+            self._log_failure("Config request", chat_id, e)
+            self.bot.editMessageText(msg_id, "❌ Could not reach the service. Please try again.")
             self.clear_status(chat_id)
 
     def cb_show_current_info(self, query_id, chat_id, msg_query, *args):
         self.bot.answerCallbackQuery(query_id)
         
         state = self.get_status(chat_id)
-        if not state or not state.get('data'):
+        if not state or not state.data:
             self.bot.sendMessage(chat_id, "❌ Session expired.")
             return
             
-        data = state['data']
+        data = state.data
         config = data.get("config", {})
         svc = data.get("service_name")
         msg_id = telepot.message_identifier(msg_query['message'])
@@ -339,20 +422,16 @@ class BotHandlers:
         if not config:
             txt += "_No settings found._"
         else:
-            for k, v in config.items():
-                details = get_setting_details(k)
-                name = details.get('name', k)
-                txt += f"▪️ *{name}*: `{v}`\n"
+            txt += "".join(f"▪️ *{get_setting_details(k).name}*: `{v}`\n" for k, v in config.items())
         
-        buttons = [[InlineKeyboardButton(text="« Back", callback_data="cb_service_menu_back")]]
-        self.bot.editMessageText(msg_id, txt, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        self.bot.editMessageText(msg_id, txt, parse_mode="Markdown", reply_markup=SERVICE_BACK_KEYBOARD)
 
     def cb_service_modify(self, query_id, chat_id, msg_query, *args):
         self.bot.answerCallbackQuery(query_id)
         state = self.get_status(chat_id)
-        if not state or not state.get('data'): return
+        if not state or not state.data: return
         
-        data = state['data']
+        data = state.data
         config = data.get("config", {})
         svc = data.get("service_name")
         msg_id = telepot.message_identifier(msg_query['message'])
@@ -363,41 +442,41 @@ class BotHandlers:
         # TimerUsageControl
         if svc == "TimerUsageControl":
             val = config.get('max_door_open_seconds', 'N/A')
-            buttons.append([InlineKeyboardButton(text=f"Max Door Open: {val}s", callback_data="cb_change_value max_door_open_seconds")])
+            buttons.append([{"text": f"Max Door Open: {val}s", "callback_data": "cb_change_value max_door_open_seconds"}])
             val = config.get('check_interval', 'N/A')
-            buttons.append([InlineKeyboardButton(text=f"Check Interval: {val}s", callback_data="cb_change_value check_interval")])
+            buttons.append([{"text": f"Check Interval: {val}s", "callback_data": "cb_change_value check_interval"}])
             
             field = 'enable_door_closed_alerts'
             det = get_setting_details(field)
-            curr = det.get("true_text") if config.get(field) else det.get("false_text")
-            buttons.append([InlineKeyboardButton(text=f"{det['name']}: {curr}", callback_data=f"cb_edit_boolean {field}")])
+            curr = det.true_text if config.get(field) else det.false_text
+            buttons.append([{"text": f"{det.name}: {curr}", "callback_data": f"cb_edit_boolean {field}"}])
 
         # FoodSpoilageControl
         elif svc == "FoodSpoilageControl":
             val = config.get('gas_threshold_ppm', 'N/A')
-            buttons.append([InlineKeyboardButton(text=f"Gas Threshold: {val} PPM", callback_data="cb_change_value gas_threshold_ppm")])
+            buttons.append([{"text": f"Gas Threshold: {val} PPM", "callback_data": "cb_change_value gas_threshold_ppm"}])
             val = config.get('alert_cooldown_minutes', 'N/A')
-            buttons.append([InlineKeyboardButton(text=f"Alert Cooldown: {val} min", callback_data="cb_change_value alert_cooldown_minutes")])
+            buttons.append([{"text": f"Alert Cooldown: {val} min", "callback_data": "cb_change_value alert_cooldown_minutes"}])
             
             field = 'enable_continuous_alerts'
             det = get_setting_details(field)
-            curr = det.get("true_text") if config.get(field) else det.get("false_text")
-            buttons.append([InlineKeyboardButton(text=f"{det['name']}: {curr}", callback_data=f"cb_edit_boolean {field}")])
+            curr = det.true_text if config.get(field) else det.false_text
+            buttons.append([{"text": f"{det.name}: {curr}", "callback_data": f"cb_edit_boolean {field}"}])
 
         # FridgeStatusControl
         elif svc == "FridgeStatusControl":
-            buttons.append([InlineKeyboardButton(text=f"Min Temp: {config.get('temp_min_celsius')}°C", callback_data="cb_change_value temp_min_celsius")])
-            buttons.append([InlineKeyboardButton(text=f"Max Temp: {config.get('temp_max_celsius')}°C", callback_data="cb_change_value temp_max_celsius")])
-            buttons.append([InlineKeyboardButton(text=f"Max Humidity: {config.get('humidity_max_percent')}%", callback_data="cb_change_value humidity_max_percent")])
+            buttons.append([{"text": f"Min Temp: {config.get('temp_min_celsius')}°C", "callback_data": "cb_change_value temp_min_celsius"}])
+            buttons.append([{"text": f"Max Temp: {config.get('temp_max_celsius')}°C", "callback_data": "cb_change_value temp_max_celsius"}])
+            buttons.append([{"text": f"Max Humidity: {config.get('humidity_max_percent')}%", "callback_data": "cb_change_value humidity_max_percent"}])
             
             field = 'enable_malfunction_alerts'
             det = get_setting_details(field)
-            curr = det.get("true_text") if config.get(field) else det.get("false_text")
-            buttons.append([InlineKeyboardButton(text=f"{det['name']}: {curr}", callback_data=f"cb_edit_boolean {field}")])
+            curr = det.true_text if config.get(field) else det.false_text
+            buttons.append([{"text": f"{det.name}: {curr}", "callback_data": f"cb_edit_boolean {field}"}])
 
-        buttons.append([InlineKeyboardButton(text="« Back", callback_data="cb_service_menu_back")])
+        buttons.append(SERVICE_BACK_ROW)
         
-        self.bot.editMessageText(msg_id, f"✏️ Modify *{escape_markdown(svc)}*\nSelect a setting:", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        self.bot.editMessageText(msg_id, f"✏️ Modify *{escape_markdown(svc)}*\nSelect a setting:", parse_mode="Markdown", reply_markup={"inline_keyboard": buttons})
 
     def cb_change_value(self, query_id, chat_id, msg_query, *args):
         field = args[0]
@@ -406,16 +485,16 @@ class BotHandlers:
         
         state = self.get_status(chat_id)
         if not state: return
-        data = state['data']
+        data = state.data
         
         data['field_name'] = field
         data['msg_identifier'] = msg_id
         self.set_status(chat_id, "waiting_for_new_value", **data)
         
         det = get_setting_details(field)
-        txt = (f"✏️  *{det['name']}*\n\n"
-               f"_{escape_markdown(det['desc'])}_\n\n"
-               f"Enter new value {escape_markdown(det['range_text'])}:\n"
+        txt = (f"✏️  *{det.name}*\n\n"
+               f"_{escape_markdown(det.desc)}_\n\n"
+               f"Enter new value {escape_markdown(det.range_text)}:\n"
                f"(Type /cancel to abort)")
         
         self.bot.editMessageText(msg_id, txt, parse_mode="Markdown")
@@ -426,15 +505,7 @@ class BotHandlers:
         msg_id = telepot.message_identifier(msg_query['message'])
         
         det = get_setting_details(field)
-        buttons = [
-            [
-                InlineKeyboardButton(text=f"✅ {det.get('true_text','True')}", callback_data=f"cb_set_boolean {field} True"),
-                InlineKeyboardButton(text=f"❌ {det.get('false_text','False')}", callback_data=f"cb_set_boolean {field} False")
-            ],
-            [InlineKeyboardButton(text="« Back", callback_data="cb_service_modify")]
-        ]
-        
-        self.bot.editMessageText(msg_id, f"Set *{det['name']}*:", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        self.bot.editMessageText(msg_id, f"Set *{det.name}*:", parse_mode="Markdown", reply_markup=boolean_keyboard(field))
 
     def cb_set_boolean(self, query_id, chat_id, msg_query, *args):
         field, val_str = args[0], args[1]
@@ -447,18 +518,17 @@ class BotHandlers:
         state = self.get_status(chat_id)
         if state:
             msg_id = telepot.message_identifier(msg_query['message'])
-            self.cb_show_service_options(chat_id, msg_id, state['data'])
+            self.cb_show_service_options(chat_id, msg_id, state.data)
 
     def cb_show_service_options(self, chat_id, msg_id, state_data):
         """Show menu (Info / Modify)"""
         svc = state_data.get("service_name")
         did = state_data.get("device_id")
         buttons = [
-            [InlineKeyboardButton(text="ℹ️ Show Current Info", callback_data="cb_show_current_info")],
-            [InlineKeyboardButton(text="✏️ Modify Settings", callback_data="cb_service_modify")],
-            [InlineKeyboardButton(text="« Back to Services", callback_data=f"cb_settings_menu {did}")]
+            *SERVICE_OPTIONS_ROWS,
+            [{"text": "« Back to Services", "callback_data": f"cb_settings_menu {did}"}]
         ]
-        self.bot.editMessageText(msg_id, f"⚙️ **{escape_markdown(svc)}** Settings", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        self.bot.editMessageText(msg_id, f"⚙️ **{escape_markdown(svc)}** Settings", parse_mode="Markdown", reply_markup={"inline_keyboard": buttons})
 
     def cb_newdevice_start(self, query_id, chat_id, msg_query, *args):
         self.bot.answerCallbackQuery(query_id)
@@ -473,7 +543,10 @@ class BotHandlers:
             self.clear_status(chat_id)
             return
         
+        # The device and the chat's account do not depend on each other: fetch both at once
+        linked_user_future = self.lookups.submit(self.catalog.get_user_by_chat_id, chat_id)
         dev_info = self.catalog.find_device_by_mac(normalize_mac(mac))
+        linked_user = linked_user_future.result()
         if not dev_info:
             self.bot.sendMessage(chat_id, "❌ Device not found.")
             self.clear_status(chat_id)
@@ -483,8 +556,6 @@ class BotHandlers:
         is_assigned = dev_info.get("user_assigned", False)
         owner = dev_info.get("owner")
         
-        linked_user = self.catalog.get_user_by_chat_id(chat_id)
-        
         if is_assigned:
             if linked_user and str(owner).lower() == str(linked_user['userID']).lower():
                 self.bot.sendMessage(chat_id, "Device already linked to you.")
@@ -530,21 +601,26 @@ class BotHandlers:
             self.bot.sendMessage(chat_id, "Invalid format. Use letters and/or numbers.")
             return
         
-        # Check duplicates
-        try:
-            self.catalog.get(f"/users/{username.lower()}")
-            self.bot.sendMessage(chat_id, "❌ Username already taken. Try another.")
-            return
-        except: pass
-        
         did = state_data.get("device_id")
         try:
-            self.catalog.post("/users", {"userID": username.lower(), "userName": username, "telegram_chat_id": str(chat_id)})
+            # The catalog rejects duplicates with 409, no need for a separate lookup first
+            try:
+                self.catalog.post("/users", {"userID": username.lower(), "userName": username, "telegram_chat_id": str(chat_id)})
+            except CatalogError as e:
+                if e.status_code != 409:
+                    raise
+                # The 409 body carries the existing account: if this chat owns it (e.g. a previous
+                # attempt failed after creating it), just finish the device assignment
+                existing = (e.detail or {}).get("user") or {}
+                if str(existing.get("telegram_chat_id")) != str(chat_id):
+                    self.bot.sendMessage(chat_id, "❌ Username already taken. Try another.")
+                    return
             self.catalog.post(f"/users/{username.lower()}/assign-device", {"device_id": did})
             self.bot.sendMessage(chat_id, "✅ Registration complete!\nUse /help for the commands list.")
             self.clear_status(chat_id)
         except Exception as e:
-            self.bot.sendMessage(chat_id, f"Error: {e}")
+            self._log_failure("Registration", chat_id, e)
+            self.bot.sendMessage(chat_id, "⚠️ Registration failed. Please try again.")
 
     def handle_username_link(self, chat_id, msg, state_data):
         """
@@ -558,7 +634,8 @@ class BotHandlers:
                 self.catalog.post(f"/users/{expected}/link_telegram", {"chat_id": str(chat_id)})
                 self.bot.sendMessage(chat_id, f"✅ Success! Telegram chat linked to account `{expected}`.\nUse /help for the commands list.", parse_mode="Markdown")
             except Exception as e:
-                self.bot.sendMessage(chat_id, f"Link failed: {e}")
+                self._log_failure("Telegram link", chat_id, e)
+                self.bot.sendMessage(chat_id, "Link failed. Please try again.")
         else:
             self.bot.sendMessage(chat_id, f"❌ Incorrect username. Expected `{expected}`.", parse_mode="Markdown")
         self.clear_status(chat_id)
@@ -575,7 +652,8 @@ class BotHandlers:
             self.catalog.post(f"/devices/{did}/rename", {"user_device_name": new_name})
             self.bot.sendMessage(chat_id, f"✅ *{escape_markdown(old_name)}* has been renamed to *{escape_markdown(new_name)}*", parse_mode="Markdown")
         except Exception as e:
-            self.bot.sendMessage(chat_id, f"Error: {e}")
+            self._log_failure("Device rename", chat_id, e)
+            self.bot.sendMessage(chat_id, "⚠️ Rename failed. Please try again.")
         self.clear_status(chat_id)
 
     # enters with waiting_for_new_value
@@ -589,11 +667,13 @@ class BotHandlers:
             self.clear_status(chat_id)
         else:
             try:
+                # One float() parse; "nan"/"inf" are rejected, whole numbers are sent as int
                 new_val = float(val_str)
-                if new_val.is_integer(): new_val = int(val_str)
+                if not math.isfinite(new_val): raise ValueError("Not a finite number")
+                if new_val.is_integer(): new_val = int(new_val)
                 
-                if "min" in details and new_val < details["min"]: raise ValueError("Value too low")
-                if "max" in details and new_val > details["max"]: raise ValueError("Value too high")
+                if details.min is not None and new_val < details.min: raise ValueError("Value too low")
+                if details.max is not None and new_val > details.max: raise ValueError("Value too high")
                 
                 self._send_config_update(chat_id, field, new_val, state_data.get("msg_identifier"))
             except ValueError:
@@ -601,7 +681,7 @@ class BotHandlers:
 
     def _send_config_update(self, chat_id, field, value, msg_id):
         state = self.get_status(chat_id)
-        data = state.get('data', {})
+        data = state.data
         did = data.get("device_id")
         svc = data.get("service_name")
         
@@ -618,18 +698,15 @@ class BotHandlers:
 
     def handle_config_response(self, device_id, payload, topic_type):
         """Handles MQTT configurations (Data, Ack, Error)."""
-        target_chat = None
-        state_data = None
-        
-        for cid, st in self.user_states.items():
-            if st['state'] in ["waiting_for_config", "waiting_for_new_value"]:
-                d = st.get('data', {})
-                if d.get("device_id") == device_id:
-                    target_chat = cid
-                    state_data = d
-                    break
-        
-        if not target_chat: return
+        with self._status_lock:
+            waiting = [(chat, self.user_states.get(chat)) for chat in self.config_waiters.get(device_id, ())]
+        for target_chat, state in waiting:
+            if state:
+                self._apply_config_response(target_chat, state, payload, topic_type)
+
+    def _apply_config_response(self, target_chat, state, payload, topic_type):
+        """Shows a config reply to one chat waiting for it."""
+        state_data = state.data
         
         msg_id = state_data.get("msg_identifier")
         
@@ -1,5 +1,6 @@
 import paho.mqtt.client as PahoMQTT
 import json
+import socket
 class MyMQTT:
     def __init__(self, clientID, broker, port, notifier=None):
         self.broker = broker
@@ -21,6 +22,12 @@ class MyMQTT:
     def myOnConnect (self, paho_mqtt, userdata, flags, rc):
         if rc == 0:
             print(f"Connected to {self.broker} with result code: {rc}", flush=True)
+            # Alerts raised in the same tick go out back to back: without TCP_NODELAY, Nagle holds
+            # each small PUBLISH until the previous one is ACKed (~40 ms with delayed ACKs)
+            try:
+                paho_mqtt.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (AttributeError, OSError):
+                pass
         else:
             print(f"Failed to connect to {self.broker}. Error code: {rc}", flush=True)
 
@@ -36,9 +43,10 @@ class MyMQTT:
             print(f"Received message on {msg.topic}: {msg.payload}", flush=True)
         
 
-    def myPublish (self, topic, msg):
+    def myPublish (self, topic, msg, qos=2):
         # publish a message with a certain topic
-        self._paho_mqtt.publish(topic, json.dumps(msg), 2)
+        # compact separators: subscribers only parse the JSON, the spaces were just bytes on the wire
+        self._paho_mqtt.publish(topic, json.dumps(msg, separators=(",", ":")), qos)
        
  
     def mySubscribe (self, topic):
@@ -1,41 +1,82 @@
+import os
+import re
 import json
 import time
+import heapq
 import threading
+import traceback
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from MyMQTT import MyMQTT
 
 from timer_utils import (
     parse_senml_door_event,
     validate_config_values,
-    check_timeout_condition,
     calculate_duration
 )
 
+# Alerts and config replies are published at-least-once: the QoS 2 handshake costs two extra
+# round trips per message, and the Telegram bot reads alerts at QoS 0 anyway.
+# Door events stay subscribed at QoS 2: they are state changes, a duplicate "opened" would restart the timer.
+PUBLISH_QOS = 1
+
+# Group17/SmartChill/Devices/<model>/<device_id>/door_event: the device ID in one match, no split list
+_DOOR_EVENT_TOPIC_RE = re.compile(r"^Group17/SmartChill/Devices/[^/]+/([^/]+)/door_event$")
+
 class TimerUsageControl:
     def __init__(self, settings_file="settings.json"):
         self.settings_file = settings_file
         self.settings = self.load_settings()
+        # Mirror of settings["configVersion"], kept in step by save_settings
+        self._config_version = self.settings.get("configVersion", 0)
         
         # Service configuration
         self.service_info = self.settings["serviceInfo"]
+        # Endpoints do not change at runtime: parse the MQTT topics once
+        self.subscribe_topics = tuple(self.extract_mqtt_topics())
         self.service_id = self.service_info["serviceID"]
+        # Fields shared by every alert of a kind, built once and merged into each payload
+        self._timeout_alert_base = {"alert_type": "door_timeout", "severity": "warning", "service": self.service_id}
+        self._closed_alert_base = {"alert_type": "door_closed_after_timeout", "severity": "info", "service": self.service_id}
         self.catalog_url = self.settings["catalog"]["url"]
+        # Keep-alive session shared by all catalog calls (startup, registration thread, MQTT device checks)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
         
         # MQTT configuration
         self.mqtt_client = None
         self.broker_host = self.settings["mqtt"]["brokerIP"]
         self.broker_port = self.settings["mqtt"]["brokerPort"]
         self.connected = False
+        # Per-door-event trace lines, off by default; alerts are always printed
+        self.debug = bool(self.settings.get("debug_logging", False))
         
         # Device management
-        self.device_timers = {}      # {device_id: start_time}
-        self.alerted_devices = {}    # {device_id: alert_sent_time}
+        self.device_timers = {}      # {device_id: start_time}, time.monotonic()
+        self.alerted_devices = {}    # {device_id: alert_sent_time}, time.monotonic()
         self.known_devices = set()   # Cache
+        self._config_cache = {}      # {device_id: (configVersion, merged config)}
+        # Open doors ordered by timeout: [(deadline, device_id, start_time)], built for _deadlines_version
+        self._deadlines = []
+        self._deadlines_version = None
+        self._alert_parts = {}       # {device_id: (configVersion, timeout topic, base, closed topic, base)}
+        # (unix second, ISO string) reused by every alert/reply published within that second
+        self._ts_cache = (None, "")
         
         # Threading
         self.running = True
+        # Set by shutdown(): wakes run() and the worker threads right away
+        self.stop_event = threading.Event()
         self.config_lock = threading.RLock()
+        # Unknown devices are looked up in the catalog off the MQTT thread.
+        # Their door events wait here, in order, until the lookup ends: {device_id: [(event_type, event_data)]}
+        self._pending_devices = {}
+        self._pending_lock = threading.Lock()
+        self._catalog_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="catalog_check")
         
         print(f"[INIT] {self.service_id} service starting...")
     
@@ -55,20 +96,32 @@ class TimerUsageControl:
         """Save current settings to file"""
         with self.config_lock:
             self.settings["lastUpdate"] = datetime.now(timezone.utc).isoformat()
-            self.settings["configVersion"] += 1
+            self._config_version = self.settings["configVersion"] = self._config_version + 1
             try:
-                with open(self.settings_file, 'w') as f:
-                    json.dump(self.settings, f, indent=4)
+                # Serialize in one call, then swap a temp file in: a crash mid-write never truncates the settings
+                data = json.dumps(self.settings, indent=4)
+                tmp_file = f"{self.settings_file}.tmp"
+                with open(tmp_file, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_file, self.settings_file)
                 print(f"[CONFIG] Settings saved to {self.settings_file}")
             except Exception as e:
                 print(f"[ERROR] Failed to save settings: {e}")
     
+    def _now_iso(self):
+        """Current UTC time in ISO format, to the second; formatted once per second"""
+        sec = int(time.time())
+        cached = self._ts_cache
+        if cached[0] != sec:
+            cached = self._ts_cache = (sec, datetime.fromtimestamp(sec, tz=timezone.utc).isoformat())
+        return cached[1]
+    
     def extract_mqtt_topics(self):
         """Extract MQTT topics from service endpoints"""
         subscribe_topics = []
         for endpoint in self.service_info["endpoints"]:
             if endpoint.startswith("MQTT Subscribe: "):
-                topic = endpoint.replace("MQTT Subscribe: ", "")
+                topic = endpoint.removeprefix("MQTT Subscribe: ")
                 subscribe_topics.append(topic)
         return subscribe_topics
     
@@ -86,7 +139,7 @@ class TimerUsageControl:
                     "status": "active"
                 }
                 
-                response = requests.post(f"{self.catalog_url}/services/register", json=registration_data, timeout=5)
+                response = self.http.post(f"{self.catalog_url}/services/register", json=registration_data, timeout=5)
                 if response.status_code in [200, 201]:
                     print(f"[REGISTER] Successfully registered with catalog")
                     return True
@@ -99,7 +152,7 @@ class TimerUsageControl:
     def check_device_exists_in_catalog(self, device_id):
         """Check if device exists in catalog via REST API"""
         try:
-            response = requests.get(f"{self.catalog_url}/devices/{device_id}/exists", timeout=5)
+            response = self.http.get(f"{self.catalog_url}/devices/{device_id}/exists", timeout=5)
             if response.status_code == 200:
                 result = response.json()
                 if result.get("exists", False):
@@ -119,27 +172,40 @@ class TimerUsageControl:
         """Auto-register device with default settings"""
         with self.config_lock:
             if device_id not in self.settings["devices"]:
-                self.settings["devices"][device_id] = {
-                    "max_door_open_seconds": self.settings["defaults"]["max_door_open_seconds"],
-                    "check_interval": self.settings["defaults"]["check_interval"],
-                    "enable_door_closed_alerts": True
-                }
+                self.settings["devices"][device_id] = self._default_device_entry()
                 self.save_settings()
                 print(f"[AUTO-REG] Device {device_id} registered with defaults")
     
+    def _default_device_entry(self):
+        return {
+            "max_door_open_seconds": self.settings["defaults"]["max_door_open_seconds"],
+            "check_interval": self.settings["defaults"]["check_interval"],
+            "enable_door_closed_alerts": True
+        }
+    
     def get_device_config(self, device_id):
-        """Get configuration for specific device"""
+        """Get configuration for specific device (shared dict: do not modify it)"""
         with self.config_lock:
+            # Every settings change goes through save_settings, which bumps configVersion
+            version = self._config_version
+            cached = self._config_cache.get(device_id)
+            if cached and cached[0] == version:
+                return cached[1]
             device_config = self.settings["devices"].get(device_id, {})
             defaults = self.settings["defaults"]
-            return {**defaults, **device_config}
+            merged = {**defaults, **device_config}
+            self._config_cache[device_id] = (version, merged)
+            return merged
     
     def update_device_config(self, device_id, new_config):
         """Update configuration for a specific device"""
         with self.config_lock:
-            if device_id not in self.settings["devices"]:
-                self.settings["devices"][device_id] = {}
-            self.settings["devices"][device_id].update(new_config)
+            device_config = self.settings["devices"].setdefault(device_id, {})
+            # Nothing to write (and no configVersion bump) when the values are already set
+            if all(k in device_config and device_config[k] == v for k, v in new_config.items()):
+                print(f"[CONFIG] Config for {device_id} unchanged")
+                return
+            device_config.update(new_config)
             self.save_settings()
             print(f"[CONFIG] Updated config for {device_id}")
 
@@ -197,8 +263,10 @@ class TimerUsageControl:
                 if val_err: self.send_config_error("invalid_config", val_err, topic); return
                 
                 with self.config_lock:
-                    self.settings["defaults"].update(new_config)
-                    self.save_settings()
+                    defaults = self.settings["defaults"]
+                    if not all(k in defaults and defaults[k] == v for k, v in new_config.items()):
+                        defaults.update(new_config)
+                        self.save_settings()
                 self.send_config_ack(None, "defaults_updated", new_config, topic)
                 
         except Exception as e:
@@ -222,107 +290,185 @@ class TimerUsageControl:
             topic_parts = original_topic.split('/')
             requester = topic_parts[3] if len(topic_parts) > 4 else "unknown"
             topic = f"Group17/SmartChill/TimerUsageControl/{requester}/{suffix}"
-            payload = {"timestamp": datetime.now(timezone.utc).isoformat(), "config_version": self.settings["configVersion"], "original_topic": original_topic, **payload_extra}
-            self.mqtt_client.myPublish(topic, payload)
+            payload = {"timestamp": self._now_iso(), "config_version": self._config_version, "original_topic": original_topic, **payload_extra}
+            self.mqtt_client.myPublish(topic, payload, PUBLISH_QOS)
         except Exception as e: print(f"[CONFIG] Error sending response: {e}")
 
     # ===================== Door Event Logic =====================
 
     def handle_door_opened(self, device_id, event_data):
         """Handle door opened event - start timer"""
-        self.device_timers[device_id] = time.time()
-        print(f"[TIMER] Door OPENED for {device_id}")
+        # Monotonic: an NTP step of the wall clock must not shorten or stretch an open-door timer
+        start_time = time.monotonic()
+        threshold = self.get_device_config(device_id)["max_door_open_seconds"]
+        with self.config_lock:
+            self.device_timers[device_id] = start_time
+            heapq.heappush(self._deadlines, (start_time + threshold, device_id, start_time))
+        if self.debug:
+            print(f"[TIMER] Door OPENED for {device_id}")
     
     def handle_door_closed(self, device_id, event_data):
         """Handle door closed event - stop timer and alert if needed"""
-        if device_id in self.device_timers:
-            duration = calculate_duration(self.device_timers[device_id])
-            del self.device_timers[device_id]
-            
-            config = self.get_device_config(device_id)
-            
-            # If device was alerted, send closed notification
-            if device_id in self.alerted_devices and config.get("enable_door_closed_alerts", True):
-                self.send_door_closed_alert(device_id, duration)
-                del self.alerted_devices[device_id]
-                print(f"[TIMER] Door CLOSED for {device_id} after {duration:.1f}s - ALERT SENT")
-            else:
-                print(f"[TIMER] Door CLOSED for {device_id} after {duration:.1f}s")
+        # Same lock as check_door_timeouts: events replayed off the MQTT thread can race the scan
+        with self.config_lock:
+            start_time = self.device_timers.pop(device_id, None)
+            if start_time is None: return
+            # Its deadline stays in the heap and is skipped as stale when it comes due
+            duration = calculate_duration(start_time)
+            # Cleared whether or not the closed alert is enabled, so the next opening can time out again
+            was_alerted = self.alerted_devices.pop(device_id, None) is not None
+            # Config only looked up for alerted doors
+            send_alert = was_alerted and self.get_device_config(device_id).get("enable_door_closed_alerts", True)
+        
+        # Published outside the lock, like the timeout alerts
+        if send_alert:
+            self.send_door_closed_alert(device_id, duration)
+            print(f"[TIMER] Door CLOSED for {device_id} after {duration:.1f}s - ALERT SENT")
+        elif self.debug:
+            print(f"[TIMER] Door CLOSED for {device_id} after {duration:.1f}s")
     
+    def _rebuild_deadlines(self):
+        """Recompute the deadline heap from the open timers (thresholds changed)"""
+        self._deadlines = [
+            (start_time + self.get_device_config(device_id)["max_door_open_seconds"], device_id, start_time)
+            for device_id, start_time in list(self.device_timers.items())
+            if device_id not in self.alerted_devices
+        ]
+        heapq.heapify(self._deadlines)
+        self._deadlines_version = self._config_version
+
     def check_door_timeouts(self):
-        """Check for open doors exceeding thresholds"""
-        current_time = time.time()
+        """Check for open doors exceeding thresholds. Returns seconds until the next deadline, or None"""
+        current_time = time.monotonic()
+        expired = []
         
-        for device_id, start_time in list(self.device_timers.items()):
-            duration = calculate_duration(start_time, current_time)
-            config = self.get_device_config(device_id)
-            threshold = config["max_door_open_seconds"]
+        with self.config_lock:
+            if self._deadlines_version != self._config_version:
+                self._rebuild_deadlines()
+            
+            # Only doors whose deadline has passed are looked at
+            deadlines = self._deadlines
+            while deadlines and deadlines[0][0] <= current_time:
+                _, device_id, start_time = heapq.heappop(deadlines)
+                # Stale entry: the door was closed (and maybe reopened) since it was queued
+                if self.device_timers.get(device_id) != start_time or device_id in self.alerted_devices:
+                    continue
+                # calculate_duration inlined: this runs for every due door
+                duration = current_time - start_time
+                threshold = self.get_device_config(device_id)["max_door_open_seconds"]
+                if duration >= threshold:
+                    self.alerted_devices[device_id] = current_time
+                    expired.append((device_id, duration, threshold))
             
-            if check_timeout_condition(duration, threshold) and device_id not in self.alerted_devices:
-                self.send_door_timeout_alert(device_id, duration)
-                self.alerted_devices[device_id] = current_time
-                print(f"[TIMEOUT] Alert for {device_id} - {duration:.0f}s > {threshold}s")
+            next_due = deadlines[0][0] - current_time if deadlines else None
+        
+        for device_id, duration, threshold in expired:
+            self.send_door_timeout_alert(device_id, duration)
+            print(f"[TIMEOUT] Alert for {device_id} - {duration:.0f}s > {threshold}s")
+        return next_due
+    
+    def _device_alert_parts(self, device_id):
+        """Topics and constant payload fields of a device's alerts, rebuilt when its config changes"""
+        version = self._config_version
+        parts = self._alert_parts.get(device_id)
+        if parts is None or parts[0] != version:
+            # Version read first: a config saved meanwhile leaves this entry stale, never mislabelled
+            config = self.get_device_config(device_id)
+            const = {"device_id": device_id, "threshold_seconds": config["max_door_open_seconds"]}
+            prefix = f"Group17/SmartChill/{device_id}/Alerts/"
+            parts = self._alert_parts[device_id] = (
+                version,
+                prefix + "DoorTimeout", {**self._timeout_alert_base, **const},
+                prefix + "DoorClosed", {**self._closed_alert_base, **const},
+            )
+        return parts
     
     def send_door_timeout_alert(self, device_id, duration):
         if not self.connected: return
-        config = self.get_device_config(device_id)
-        
-        alert_topic = f"Group17/SmartChill/{device_id}/Alerts/DoorTimeout"
+        _, alert_topic, base, _, _ = self._device_alert_parts(device_id)
         alert_payload = {
-            "alert_type": "door_timeout",
-            "device_id": device_id,
-            "message": f"Door open for {duration:.0f}s (threshold: {config['max_door_open_seconds']}s)",
+            **base,
+            "message": f"Door open for {duration:.0f}s (threshold: {base['threshold_seconds']}s)",
             "duration_seconds": round(duration, 1),
-            "threshold_seconds": config['max_door_open_seconds'],
-            "severity": "warning",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "service": self.service_id
+            "timestamp": self._now_iso(),
         }
-        self.mqtt_client.myPublish(alert_topic, alert_payload)
+        self.mqtt_client.myPublish(alert_topic, alert_payload, PUBLISH_QOS)
     
     def send_door_closed_alert(self, device_id, total_duration):
         if not self.connected: return
-        config = self.get_device_config(device_id)
-        
-        alert_topic = f"Group17/SmartChill/{device_id}/Alerts/DoorClosed"
+        _, _, _, alert_topic, base = self._device_alert_parts(device_id)
         alert_payload = {
-            "alert_type": "door_closed_after_timeout",
-            "device_id": device_id,
+            **base,
             "message": f"Door closed after {total_duration:.0f}s (was over threshold)",
             "total_duration_seconds": round(total_duration, 1),
-            "threshold_seconds": config['max_door_open_seconds'],
-            "severity": "info",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "service": self.service_id
+            "timestamp": self._now_iso(),
         }
-        self.mqtt_client.myPublish(alert_topic, alert_payload)
+        self.mqtt_client.myPublish(alert_topic, alert_payload, PUBLISH_QOS)
 
     # ===================== MQTT & Lifecycle =====================
 
     def notify(self, topic, payload):
         """Callback for SenML door events"""
         try:
-            if "config_update" in topic:
+            # Classify by the last topic level before touching the payload
+            kind = topic.rpartition('/')[2]
+            if kind == "config_update":
                 self.handle_config_update(topic, payload); return
+            if kind != "door_event": return
             
             door_event_data = parse_senml_door_event(payload)
             if not door_event_data: return
             
-            topic_parts = topic.split('/')
-            device_id = door_event_data.get("device_id") or (topic_parts[-2] if len(topic_parts)>=5 else None)
+            device_id = door_event_data.get("device_id")
+            if not device_id:
+                match = _DOOR_EVENT_TOPIC_RE.match(topic)
+                device_id = match.group(1) if match else None
             event_type = door_event_data.get("event_type")
             
-            if device_id not in self.known_devices:
-                if not self.check_device_exists_in_catalog(device_id): return
+            if device_id not in self.known_devices or device_id in self._pending_devices:
+                self._defer_door_event(device_id, event_type, door_event_data); return
             
-            if event_type == "door_opened":
-                self.handle_door_opened(device_id, door_event_data)
-            elif event_type == "door_closed":
-                self.handle_door_closed(device_id, door_event_data)
+            self._dispatch_door_event(device_id, event_type, door_event_data)
                 
         except Exception as e:
             print(f"[ERROR] notify: {e}")
-            import traceback; traceback.print_exc()
+            # A publisher sending bad messages would otherwise flood stdout from the MQTT thread
+            if self.debug: traceback.print_exc()
+
+    def _dispatch_door_event(self, device_id, event_type, event_data):
+        if event_type == "door_opened":
+            self.handle_door_opened(device_id, event_data)
+        elif event_type == "door_closed":
+            self.handle_door_closed(device_id, event_data)
+
+    def _defer_door_event(self, device_id, event_type, event_data):
+        """Queue an event of a device not yet known and start its catalog lookup if none is running"""
+        with self._pending_lock:
+            pending = self._pending_devices.get(device_id)
+            if pending is not None:
+                pending.append((event_type, event_data)); return
+            self._pending_devices[device_id] = [(event_type, event_data)]
+        self._catalog_pool.submit(self._resolve_device, device_id)
+
+    def _resolve_device(self, device_id):
+        """Check a device in the catalog, then replay its queued events (or drop them if it does not exist)"""
+        try:
+            exists = device_id in self.known_devices or self.check_device_exists_in_catalog(device_id)
+        except Exception as e:
+            print(f"[DEVICE_CHECK] Error: {e}"); exists = False
+        while True:
+            with self._pending_lock:
+                events = self._pending_devices[device_id]
+                if not exists or not events:
+                    # Later events go straight to the handlers (or start a new lookup)
+                    del self._pending_devices[device_id]
+                    return
+                self._pending_devices[device_id] = []
+            for event_type, event_data in events:
+                try:
+                    self._dispatch_door_event(device_id, event_type, event_data)
+                except Exception as e:
+                    print(f"[ERROR] door event for {device_id}: {e}")
 
     def setup_mqtt(self):
         try:
@@ -332,7 +478,7 @@ class TimerUsageControl:
             time.sleep(2)
             self.connected = True
             
-            topics = self.extract_mqtt_topics()
+            topics = self.subscribe_topics
             for topic in topics:
                 self.mqtt_client.mySubscribe(topic)
                 print(f"[MQTT] Subscribed: {topic}")
@@ -341,28 +487,39 @@ class TimerUsageControl:
 
     def load_known_devices_from_catalog(self):
         try:
-            response = requests.get(f"{self.catalog_url}/devices", timeout=5)
+            response = self.http.get(f"{self.catalog_url}/devices", timeout=5)
             if response.status_code == 200:
-                for device in response.json():
-                    did = device.get("deviceID")
-                    if did and did.startswith("SmartChill_"):
-                        self.known_devices.add(did)
-                        if did not in self.settings["devices"]: self.auto_register_device(did)
+                catalog_ids = {did for device in response.json()
+                               if (did := device.get("deviceID")) and did.startswith("SmartChill_")}
+                self.known_devices.update(catalog_ids)
+                # New devices get their defaults in one pass and one settings write
+                with self.config_lock:
+                    missing = catalog_ids - self.settings["devices"].keys()
+                    for did in sorted(missing):
+                        self.settings["devices"][did] = self._default_device_entry()
+                    if missing:
+                        self.save_settings()
+                        print(f"[AUTO-REG] {len(missing)} devices registered with defaults")
                 print(f"[INIT] Loaded {len(self.known_devices)} devices")
         except Exception as e: print(f"[INIT] Catalog error: {e}")
 
     def monitoring_loop(self):
-        while self.running:
+        while not self.stop_event.is_set():
             try:
-                self.check_door_timeouts()
-                time.sleep(self.settings["defaults"]["check_interval"])
-            except Exception as e: print(f"[ERROR] Loop: {e}"); time.sleep(5)
+                started = time.monotonic()
+                next_due = self.check_door_timeouts()
+                interval = self.settings["defaults"]["check_interval"]
+                # Wake up for the next deadline, but at least every check_interval.
+                # Both are counted from the start of the check, so its own run time does not add drift.
+                timeout = interval if next_due is None else min(interval, max(0.1, next_due))
+                self.stop_event.wait(max(0.0, timeout - (time.monotonic() - started)))
+            except Exception as e: print(f"[ERROR] Loop: {e}"); self.stop_event.wait(5)
 
     def periodic_registration(self):
         interval = self.settings["catalog"]["registration_interval_seconds"]
-        while self.running:
-            time.sleep(interval)
-            if self.running: self.register_with_catalog()
+        # wait() returns True as soon as shutdown() is called
+        while not self.stop_event.wait(interval):
+            self.register_with_catalog()
 
     def run(self):
         print("="*60 + "\n    SMARTCHILL TIMER USAGE CONTROL\n" + "="*60)
@@ -374,9 +531,11 @@ class TimerUsageControl:
         threading.Thread(target=self.periodic_registration, daemon=True).start()
         
         try:
-            while self.running: time.sleep(1)
+            self.stop_event.wait()
         except KeyboardInterrupt: self.shutdown()
 
     def shutdown(self):
-        print("[SHUTDOWN] Stopping service..."); self.running = False
-        if self.mqtt_client: self.mqtt_client.stop()
\ No newline at end of file
+        print("[SHUTDOWN] Stopping service..."); self.running = False; self.stop_event.set()
+        if self.mqtt_client: self.mqtt_client.stop()
+        self._catalog_pool.shutdown(wait=False, cancel_futures=True)
+        self.http.close()
\ No newline at end of file
@@ -4,13 +4,25 @@ from datetime import datetime
 
 # ===================== Data Parsing =====================
 
+def _read_door_state(entry, event_data, base_time, device_id):
+    event_data["event_type"] = entry.get("vs")
+    event_data["timestamp"] = base_time + entry.get("t", 0)
+    event_data["device_id"] = device_id
+
+def _read_door_duration(entry, event_data, base_time, device_id):
+    event_data["door_open_duration"] = entry.get("v")
+
+# SenML record name -> reader; records with other names are ignored
+_ENTRY_READERS = {
+    "door_state": _read_door_state,
+    "door_duration": _read_door_duration,
+}
+
 def parse_senml_door_event(payload):
     """Parse SenML payload and extract door event data"""
     try:
-        if isinstance(payload, bytes):
-            payload = payload.decode("utf-8")
-
-        senml_data = json.loads(payload) if isinstance(payload, str) else payload
+        # json.loads reads the raw MQTT bytes directly (UTF-8 detected), no separate decode pass
+        senml_data = json.loads(payload) if isinstance(payload, (bytes, bytearray, str)) else payload
         
         if not isinstance(senml_data, dict) or "e" not in senml_data:
             print(f"[SENML] Invalid SenML structure")
@@ -23,30 +35,23 @@ def parse_senml_door_event(payload):
         device_id = base_name.rstrip("/") if base_name.endswith("/") else None
         
         event_data = {}
+        readers = _ENTRY_READERS
         for entry in entries:
             if not isinstance(entry, dict): continue
-            
-            name = entry.get("n")
-            time_offset = entry.get("t", 0)
-            
-            # Door State
-            if name == "door_state":
-                event_data["event_type"] = entry.get("vs")
-                event_data["timestamp"] = base_time + time_offset
-                event_data["device_id"] = device_id
-            
-            # Door Duration
-            elif name == "door_duration":
-                event_data["door_open_duration"] = entry.get("v")
+            reader = readers.get(entry.get("n"))
+            if reader:
+                reader(entry, event_data, base_time, device_id)
         
         return event_data if "event_type" in event_data else None
         
-    except (json.JSONDecodeError, TypeError) as e:
+    except (json.JSONDecodeError, UnicodeDecodeError, TypeError) as e:
         print(f"[SENML] Error parsing door event: {e}")
         return None
 
 # ===================== Validation Logic =====================
 
+_ALLOWED_CONFIG_KEYS = frozenset({"max_door_open_seconds", "check_interval", "enable_door_closed_alerts"})
+
 def validate_config_values(config):
     """Validate configuration values"""
     
@@ -67,20 +72,15 @@ def validate_config_values(config):
         if not isinstance(config["enable_door_closed_alerts"], bool):
             return "enable_door_closed_alerts must be boolean"
     
-    allowed = {"max_door_open_seconds", "check_interval", "enable_door_closed_alerts"}
-    unknown = set(config.keys()) - allowed
+    unknown = config.keys() - _ALLOWED_CONFIG_KEYS
     if unknown: return f"Unknown keys: {', '.join(unknown)}"
     
     return None
 
 # ===================== Evaluation Logic =====================
 
-def check_timeout_condition(duration, threshold):
-    """Check if door open duration exceeds threshold"""
-    return duration >= threshold
-
 def calculate_duration(start_time, end_time=None):
-    """Calculate duration in seconds"""
+    """Calculate duration in seconds between two time.monotonic() readings"""
     if end_time is None:
-        end_time = time.time()
+        end_time = time.monotonic()
     return end_time - start_time
\ No newline at end of file